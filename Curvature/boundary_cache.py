@@ -0,0 +1,108 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from utils import save_npz_atomic
+
+
+class BoundaryCache:
+    """
+    Content-addressed disk cache for the expensive parts of the curvature experiments (boundary images, gradients,
+    Hessians or their low-rank factors). Entries are keyed on a hash of everything they depend on (model weights,
+    images, labels and search parameters), so different run types and restarted jobs reuse each others work.
+    Every entry is a single npz file; the least recently used entries are removed once the cache grows beyond
+    max_bytes.
+    """
+    def __init__(self, directory, max_bytes=10 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._model_hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def model_hash(self, model):
+        """
+        Hash of the model weights, computed once per model object.
+        """
+        if id(model) not in self._model_hashes:
+            sha = hashlib.sha1()
+            for name, tensor in model.state_dict().items():
+                sha.update(name.encode())
+                sha.update(tensor.detach().cpu().numpy().tobytes())
+            self._model_hashes[id(model)] = sha.hexdigest()
+        return self._model_hashes[id(model)]
+
+    def key(self, *parts):
+        sha = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, torch.Tensor):
+                part = part.detach().cpu().numpy()
+            if isinstance(part, np.ndarray):
+                sha.update(str((part.dtype, part.shape)).encode())
+                sha.update(np.ascontiguousarray(part).tobytes())
+            else:
+                sha.update(repr(part).encode())
+        return sha.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        Returns the entry as a dict of arrays, or None if it is not cached.
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as data:
+                entry = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # the modification time is the last use for the eviction
+        try:
+            os.utime(filename)
+        except FileNotFoundError: # evicted by another job since
+            pass
+        return entry
+
+    def save(self, key, entry):
+        filename = self._filename(key)
+        # forked workers may save the same entry at once, each through its own temporary file
+        save_npz_atomic(filename, **entry)
+        self.evict(keep=filename)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached entry for key, or computes (compute() -> dict of arrays), stores and returns it.
+        """
+        entry = self.load(key)
+        if entry is None:
+            entry = {name: np.asarray(value) for name, value in compute().items()}
+            self.save(key, entry)
+        return entry
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is at most max_bytes (never the entry keep).
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError: # removed by another job
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError: # evicted by another job at the same time
+                pass
+            total_size -= size
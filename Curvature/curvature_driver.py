@@ -0,0 +1,78 @@
+"""
+Runs the experiments of subspace_curvature.py for all run types and image indices of a dataset in a single job,
+instead of one job per (dataset_type, run_type, image_index) as in run_all.sh. The models, data and index files are
+loaded once and shared with a pool of worker processes.
+Experiments that need the same boundary images and Hessians (same model, data and origin image, e.g. run types 2, 4
+and 6) are grouped and run one after the other by the same worker, so all but the first read them from the
+BoundaryCache. Experiments with an existing output file are skipped, so a restarted job continues where it stopped.
+
+usage:
+    python curvature_driver.py dataset_type [n_workers]
+"""
+
+import os
+import sys
+
+import subspace_curvature as sc
+from boundary_cache import BoundaryCache
+from utils import dev, run_pool
+
+experiment = None
+boundary_cache = None
+
+
+def group_key(task):
+    """
+    Experiments with the same key share their boundary images and Hessians.
+    """
+    run_type, image_index = task
+    model_, data_, origin_indices, run_name = sc.select_run(experiment, run_type, image_index)
+    return (id(model_), id(data_), int(origin_indices[0]))
+
+
+def group_tasks(tasks):
+    groups = {}
+    for task in tasks:
+        groups.setdefault(group_key(task), []).append(task)
+    return list(groups.values())
+
+
+def cache_filename(dataset_type, task):
+    run_type, image_index = task
+    return experiment['filename_prefix'] + f'cache/{dataset_type}-{run_type}-{image_index}-cachefile.npz'
+
+
+def run_group(args):
+    dataset_type, group = args
+    for task in group:
+        # the CurvatureStore of the experiment, named as the CACHEFILE of a job of curvature_experiments.sh
+        sc.run_experiment(experiment, *task, boundary_cache=boundary_cache,
+                          cache_filename=cache_filename(dataset_type, task))
+    return group
+
+
+def run_all(dataset_type, tasks, n_workers):
+    todo = [task for task in tasks if not os.path.isfile(sc.output_filename(experiment, *task))]
+    print('%d of %d experiments left' % (len(todo), len(tasks)))
+    os.makedirs(experiment['filename_prefix'] + 'cache', exist_ok=True)
+    args = [(dataset_type, group) for group in group_tasks(todo)]
+    for _ in run_pool(run_group, args, n_workers,
+                      shared_models=[experiment['model_natural'], experiment['model_robust']]):
+        pass
+
+
+if __name__ == "__main__":
+    print(dev())
+    dataset_type = int(sys.argv[1])
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    experiment = sc.load_experiment(dataset_type)
+    boundary_cache = sc.get_boundary_cache()
+    if boundary_cache is None:
+        boundary_cache = BoundaryCache(experiment['filename_prefix'] + 'boundary_cache')
+    # hash the weights once here instead of once per worker
+    for model in [experiment['model_natural'], experiment['model_robust']]:
+        boundary_cache.model_hash(model)
+
+    tasks = [(run_type, image_index) for run_type in range(8) for image_index in range(sc.num_images)]
+    run_all(dataset_type, tasks, n_workers)
@@ -14,6 +14,7 @@
 
 echo "parameters: $arg1 $arg2 $arg3"
 export SINGULARITYENV_CACHEFILE=/mnt/qb/bethge/shared/dylan_david_shared/cache/$arg1-$arg2-$arg3-cachefile.npz
+export SINGULARITYENV_BOUNDARY_CACHE=/mnt/qb/bethge/shared/dylan_david_shared/cache/boundary_cache
 export IMAGE=/mnt/qb/bethge/shared/dylan_david_shared/singularity/dpaiton_pytorch_latest-2021-10-03-f617935c6553.sif
 export tmp_dir=$(mktemp -d -t singularity-XXXXXXXXX)
 export LOCAL_IMAGE=$tmp_dir/image.sif
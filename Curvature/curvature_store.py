@@ -0,0 +1,55 @@
+import os
+import warnings
+
+import numpy as np
+
+from utils import save_npz_atomic
+
+
+class CurvatureStore:
+    """
+    Append-only store for the curvature loops of curve_utils.py. Every finished iteration (e.g. (model, image, adv))
+    is written to its own small file (<directory>/entry_<index>.npz) as soon as it is done, so the cost of a write
+    does not grow with the number of finished iterations, and a restarted job only reads back the iterations it
+    skips.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, index):
+        return os.path.join(self.directory, 'entry_' + '_'.join('%05d' % i for i in index) + '.npz')
+
+    def has(self, index):
+        return os.path.isfile(self._filename(index))
+
+    def write(self, index, **arrays):
+        save_npz_atomic(self._filename(index), **arrays)
+
+    def load(self, index):
+        with np.load(self._filename(index)) as data:
+            return {name: data[name] for name in data.files}
+
+    def import_npz(self, filename, fields):
+        """
+        Imports the finished iterations of a cache file in the old format (a single npz with one array per output,
+        NaN for the iterations that are not done yet), once per file. fields maps the arrays of the file to the
+        entry names of the store; an iteration is done if the first of them is not all NaN. Iterations that are
+        already in the store are kept.
+        """
+        marker = os.path.join(self.directory, 'imported_' + os.path.splitext(os.path.basename(filename))[0])
+        if os.path.isfile(marker) or not os.path.isfile(filename):
+            return
+        with np.load(filename) as data:
+            arrays = {name: data[name] for name in fields if name in data.files}
+        first = next(iter(fields))
+        done = ~np.all(np.isnan(arrays[first]), axis=-1)
+        num_imported = 0
+        for index in zip(*np.nonzero(done)):
+            index = tuple(int(i) for i in index)
+            if not self.has(index):
+                self.write(index, **{fields[name]: array[index] for name, array in arrays.items()})
+                num_imported += 1
+        warnings.warn(f'Imported {num_imported} finished iterations from the old cache file {filename} into '
+                      f'{self.directory}; the old file is no longer updated.')
+        open(marker, 'w').close()
@@ -1,6 +1,8 @@
+from contextlib import contextmanager
 from datetime import datetime
 import os
 import sys
+import warnings
 #import sleep
 
 import numpy as np
@@ -12,9 +14,11 @@ sys.path.insert(0, './..')
 sys.path.insert(0, '../data')
 
 from models import model as model_loader
-from utils import dev
+from utils import dev, load_result_dict
 from robustness1.datasets import CIFAR
 from models.cifar_models import model_zoo
+import hvp_curvature as hvp_utils
+from curvature_store import CurvatureStore
 
 sys.path.insert(0, './../..')
 
@@ -28,16 +32,74 @@ def flush():
     sys.stderr.flush()
 
 
-def torch_hessian(*args, **kwargs):
-    vectorize=False
+# modules that vmap can not batch (custom autograd.Functions) and their functional equivalents
+VMAP_REPLACEMENTS = {
+    model_zoo.Swish: model_zoo.FunctionalSwish,
+}
+
+
+@contextmanager
+def vmap_compatible(model):
+    """
+    Temporarily swaps the modules of model listed in VMAP_REPLACEMENTS for their functional equivalents.
+    """
+    replaced = []
+    if model is not None:
+        for parent in model.modules():
+            for name, child in parent.named_children():
+                if type(child) in VMAP_REPLACEMENTS:
+                    replaced.append((parent, name, child))
+                    setattr(parent, name, VMAP_REPLACEMENTS[type(child)]())
+    try:
+        yield model
+    finally:
+        for parent, name, child in replaced:
+            setattr(parent, name, child)
+
+
+def batched_hessian(func, inputs, chunk_size=256):
+    """
+    Hessian of the single element output of func, computed chunk_size rows at a time with vmap-batched backward
+    passes (is_grads_batched). Returns the same shape as torch.autograd.functional.hessian.
+    """
+    inputs = inputs.detach().clone().requires_grad_(True)
+    gradient, = torch.autograd.grad(func(inputs).sum(), inputs, create_graph=True)
+    n = inputs.numel()
+    rows = []
+    for start in range(0, n, chunk_size):
+        eye = torch.zeros((min(chunk_size, n - start), n), dtype=inputs.dtype, device=inputs.device)
+        eye[:, start:start + len(eye)] = torch.eye(len(eye), dtype=inputs.dtype, device=inputs.device)
+        rows_, = torch.autograd.grad(gradient, inputs, grad_outputs=eye.reshape((-1,) + inputs.shape),
+                                     retain_graph=True, is_grads_batched=True)
+        rows.append(rows_.reshape(len(eye), n).detach())
+    return torch.cat(rows, dim=0).reshape(inputs.shape + inputs.shape)
+
+
+def torch_hessian(*args, model=None, vectorize=False, chunk_size=256, **kwargs):
+    """
+    With vectorize, the Hessian rows are computed in vmap-batched chunks, with the vmap-incompatible modules of model
+    swapped out for the duration of the computation (see vmap_compatible). If vmap can not batch the model (e.g. a
+    custom autograd.Function that is missing from VMAP_REPLACEMENTS), this warns and falls back to the row by row
+    Hessian.
+    vmap is not necessarily faster: on a small WideResNet on the CPU it took 38s against 29s row by row (see
+    benchmark_hessian.py), which is why 'autodiff' stays the default backend.
+    """
     print(datetime.utcnow())
     print("computing hessian with vectorize=", vectorize)
     flush()
-    torch._C._debug_only_display_vmap_fallback_warnings(True)
-    hessian = torch.autograd.functional.hessian(*args, **kwargs, vectorize=vectorize)
+    hessian = None
+    if vectorize:
+        try:
+            with vmap_compatible(model):
+                hessian = batched_hessian(*args, chunk_size=chunk_size, **kwargs)
+        except (RuntimeError, NotImplementedError) as e:
+            warnings.warn(f'vmap-batched Hessian failed ({e}), falling back to vectorize=False')
+    if hessian is None:
+        torch._C._debug_only_display_vmap_fallback_warnings(True)
+        hessian = torch.autograd.functional.hessian(*args, **kwargs, vectorize=False)
+        torch._C._debug_only_display_vmap_fallback_warnings(False)
     print("hessian done")
     print(datetime.utcnow())
-    torch._C._debug_only_display_vmap_fallback_warnings(False)
     return hessian
 
 
@@ -64,25 +126,124 @@ def torchify(img):
     return output
 
 
-def get_paired_boundary_image(model, origin, alt_image, num_steps_per_iter, num_iters, batch_size=None):
-    input_shape = (1,)+origin.shape
-    def find_pert(image_line):
-        labels = get_batch_predictions(model, image_line.reshape((-1,)+origin.shape), batch_size)
-        pert_lbl = correct_lbl = labels[0]
-        step_idx = 1 # already know the first one
-        while pert_lbl == correct_lbl:
-            pert_image = image_line[step_idx, ...]
-            pert_lbl = labels[step_idx]
-            step_idx += 1
-        return step_idx-1, pert_image
-    image_line = np.linspace(origin.reshape(-1), alt_image.reshape(-1), num_steps_per_iter)
+def get_paired_boundary_images(model, origins, alt_images, num_steps_per_iter, num_iters, batch_size=None):
+    """
+    Batched version of get_paired_boundary_image for the pairs (origins[i], alt_images[i]).
+    Every search iteration evaluates num_steps_per_iter evenly spaced images on the current line segment of all
+    pairs together (in batches of batch_size images, built on the fly) and narrows each segment to the step before
+    its first label flip. Pairs without a label flip end at their alt image.
+    Returns the boundary images, the directions (origin - boundary) / |origin - boundary|, the perturbation lengths and
+    the logits of the model at the boundary images.
+    """
+    if batch_size is None:
+        batch_size = 100
+    image_shape = origins.shape[1:]
+    num_pairs = origins.shape[0]
+    pair_range = np.arange(num_pairs)
+    starts = origins.reshape(num_pairs, -1)
+    stops = alt_images.reshape(num_pairs, -1)
     for search_iter in range(num_iters):
-        step_idx, pert_image = find_pert(image_line)
-        image_line = np.linspace(image_line[step_idx - 1, ...], image_line[step_idx, ...], num_steps_per_iter)
-    delta_image = origin.reshape(-1) - pert_image
-    pert_length = np.linalg.norm(delta_image)
-    direction = delta_image / pert_length
-    return pert_image.reshape(origin.shape), direction, pert_length
+        # same points as np.linspace(starts[i], stops[i], num_steps_per_iter)
+        step_sizes = (stops - starts) / (num_steps_per_iter - 1)
+        def line_images(pair_idx, step_idx):
+            images = starts[pair_idx] + step_idx[:, None] * step_sizes[pair_idx]
+            is_last = step_idx == num_steps_per_iter - 1
+            images[is_last] = stops[pair_idx[is_last]]
+            return images
+        num_line_images = num_pairs * num_steps_per_iter
+        logits = []
+        for batch_start in range(0, num_line_images, batch_size):
+            pair_idx, step_idx = np.divmod(np.arange(batch_start, min(batch_start + batch_size, num_line_images)),
+                num_steps_per_iter)
+            batch = torchify(line_images(pair_idx, step_idx).reshape((-1,) + image_shape))
+            with torch.no_grad():
+                logits.append(model(batch).detach().cpu().numpy())
+        logits = np.concatenate(logits, axis=0).reshape((num_pairs, num_steps_per_iter, -1))
+        labels = np.argmax(logits, axis=-1)
+        flipped = labels != labels[:, :1]
+        flip_idx = np.where(np.any(flipped, axis=1), np.argmax(flipped, axis=1), num_steps_per_iter - 1)
+        pert_images = line_images(pair_range, flip_idx)
+        pert_logits = logits[pair_range, flip_idx]
+        starts, stops = line_images(pair_range, flip_idx - 1), pert_images
+    delta_images = origins.reshape(num_pairs, -1) - pert_images
+    pert_lengths = np.linalg.norm(delta_images, axis=1)
+    directions = delta_images / pert_lengths[:, None]
+    return pert_images.reshape(origins.shape), directions, pert_lengths, pert_logits
+
+
+def get_paired_boundary_image(model, origin, alt_image, num_steps_per_iter, num_iters, batch_size=None):
+    boundary_images, directions, pert_lengths, _ = get_paired_boundary_images(model, origin[None, ...],
+        alt_image[None, ...], num_steps_per_iter, num_iters, batch_size)
+    return boundary_images[0], directions[0], pert_lengths[0]
+
+
+def cached(cache, key_parts, compute):
+    """
+    Returns compute() (a dict of arrays or tensors), loaded from or stored in cache (a BoundaryCache) under the key
+    of key_parts if a cache is given. Cached tensors are returned as numpy arrays.
+    """
+    if cache is None:
+        return compute()
+    key = cache.key(*key_parts)
+    entry = cache.load(key)
+    if entry is None:
+        entry = compute()
+        cache.save(key, {name: value.detach().cpu().numpy() if torch.is_tensor(value) else np.asarray(value)
+            for name, value in entry.items()})
+    return entry
+
+
+def cached_boundary_image(model, origin, alt_image, num_steps_per_iter, num_iters, batch_size=None, cache=None):
+    """
+    get_paired_boundary_image, reused from cache if given.
+    """
+    def compute():
+        boundary_image, direction, pert_length = get_paired_boundary_image(model, origin, alt_image,
+            num_steps_per_iter, num_iters, batch_size)
+        return {'image': boundary_image, 'direction': direction, 'pert_length': pert_length}
+    key_parts = None if cache is None else ('boundary', cache.model_hash(model), origin, alt_image,
+        num_steps_per_iter, num_iters)
+    entry = cached(cache, key_parts, compute)
+    return entry['image'], entry['direction'], float(entry['pert_length'])
+
+
+def boundary_hessian(model, boundary_image, clean_lbl, adv_lbl, dtype, vectorize=False, cache=None):
+    """
+    Gradient (n,) and dense Hessian (n x n) of the paired activation at boundary_image, reused from cache if given.
+    """
+    n_pixels = int(boundary_image.size)
+    def compute():
+        def func(x):
+            return paired_activation(model, x, clean_lbl, adv_lbl)
+        hessian = torch_hessian(func, torchify(boundary_image[None,...]), model=model, vectorize=vectorize)
+        activation, gradient = paired_activation_and_gradient(model, torchify(boundary_image[None, ...]), clean_lbl, adv_lbl)
+        return {'gradient': gradient.reshape(-1).type(dtype), 'hessian': hessian.reshape((n_pixels, n_pixels)).type(dtype)}
+    key_parts = None if cache is None else ('hessian', cache.model_hash(model), boundary_image, clean_lbl, adv_lbl,
+        str(dtype))
+    entry = cached(cache, key_parts, compute)
+    return (torch.as_tensor(entry['gradient'], device=dev()).type(dtype),
+        torch.as_tensor(entry['hessian'], device=dev()).type(dtype))
+
+
+def boundary_lanczos_curvature(model, boundary_image, clean_lbl, adv_lbl, dtype, num_lanczos, cache=None):
+    """
+    Gradient and Lanczos level set curvature (shape operator, principal curvatures, principal directions, see
+    hvp_curvature.lanczos_level_set_curvature) of the paired activation at boundary_image, reused from cache if given.
+    """
+    def compute():
+        def func(x):
+            return paired_activation(model, x, clean_lbl, adv_lbl)
+        gradient, hvp = hvp_utils.make_hvp(func, torchify(boundary_image[None,...]))
+        gradient = gradient.type(dtype)
+        shape_operator, curvatures, directions = hvp_utils.lanczos_level_set_curvature(hvp, gradient, num_lanczos)
+        return {'gradient': gradient, 'shape_operator': shape_operator, 'curvatures': curvatures,
+            'directions': directions}
+    key_parts = None if cache is None else ('lanczos', cache.model_hash(model), boundary_image, clean_lbl, adv_lbl,
+        str(dtype), num_lanczos)
+    entry = cached(cache, key_parts, compute)
+    gradient, shape_operator, curvatures, directions = [torch.as_tensor(entry[name], device=dev()).type(dtype)
+        for name in ('gradient', 'shape_operator', 'curvatures', 'directions')]
+    return gradient, (shape_operator, curvatures, directions)
 
 
 def get_valid_indices(model_predictions, data, num_advs=None):
@@ -130,24 +291,24 @@ def generate_paired_dict(model, data, origin_indices, valid_indices, num_images,
     advs = np.zeros((num_images, num_advs, 1, num_pixels))
     pert_lengths = np.zeros((num_images, num_advs))
     adv_class = np.zeros((num_images, num_advs))
-    pbar = tqdm(total=len(list(origin_indices))*num_advs, leave=True)
+    pair_image_indices, pair_dir_indices, pair_alt_indices = [], [], []
     for image_idx, origin_idx in enumerate(list(origin_indices)):
         images[image_idx, ...] = data['images'][origin_idx, ...]
         labels[image_idx] = data['labels'][origin_idx]
         shuffled_valid_indices = np.random.choice(valid_indices, size=len(valid_indices), replace=False)
         alt_indices = [idx for idx, alt_class in zip(shuffled_valid_indices, data['labels'][shuffled_valid_indices]) if alt_class != labels[image_idx]]
-        alt_images = data['images'][alt_indices[:num_advs]]
         for dir_idx, alt_idx in enumerate(alt_indices[:num_advs]):
-            alt_image = data['images'][alt_idx, ...]
-            boundary_image, boundary_dir, pert_length = get_paired_boundary_image(
-                model, images[image_idx, ...], alt_image,
-                num_steps_per_iter=num_steps_per_iter, num_iters=num_iters)
-            dirs[image_idx, dir_idx, ...] = boundary_dir.reshape(1, -1)
-            advs[image_idx, dir_idx, ...] = boundary_image.reshape(1, -1)
-            adv_class[image_idx,  dir_idx] = torch.argmax(model(torchify(boundary_image[None, ...]))).item()
-            pert_lengths[image_idx, dir_idx] =  pert_length
-            pbar.update(1)
-    pbar.close()
+            pair_image_indices.append(image_idx)
+            pair_dir_indices.append(dir_idx)
+            pair_alt_indices.append(alt_idx)
+    # all pairs in one batched search, which also returns the logits for adv_class
+    boundary_images, boundary_dirs, pair_pert_lengths, boundary_logits = get_paired_boundary_images(
+        model, images[pair_image_indices], data['images'][pair_alt_indices],
+        num_steps_per_iter=num_steps_per_iter, num_iters=num_iters)
+    dirs[pair_image_indices, pair_dir_indices, ...] = boundary_dirs.reshape(-1, 1, num_pixels)
+    advs[pair_image_indices, pair_dir_indices, ...] = boundary_images.reshape(-1, 1, num_pixels)
+    adv_class[pair_image_indices, pair_dir_indices] = np.argmax(boundary_logits, axis=-1)
+    pert_lengths[pair_image_indices, pair_dir_indices] = pair_pert_lengths
     output_dict = {}
     output_dict['images'] = images
     output_dict['labels'] = labels
@@ -174,116 +335,188 @@ def paired_activation_and_gradient(model, images, neuron1, neuron2):
     return activation_difference, grad
 
 
-def get_curvature(condition_zip, origin_indices, num_advs, num_iters, num_steps_per_iter, dtype):
+def get_curvature_store(cache_filename, legacy_fields):
+    """
+    The CurvatureStore of cache_filename (the CACHEFILE of a job, the store lives next to it in
+    <cache_filename>_store), or None without a cache_filename.
+    The iterations that an older version wrote to cache_filename itself are imported into the store first (see
+    CurvatureStore.import_npz, legacy_fields maps the arrays of that file to the entry names).
+    """
+    if cache_filename is None:
+        return None
+    store = CurvatureStore(os.path.splitext(cache_filename)[0] + '_store')
+    store.import_npz(cache_filename, legacy_fields)
+    return store
+
+
+def retained_direction_indices(curvatures, num_directions=None):
+    """
+    Indices (along the last axis) of the principal directions kept by get_curvature with num_directions: those of the
+    num_directions largest |curvatures| (all for None), in their original order. NaN curvatures come last.
+    """
+    if num_directions is None or num_directions >= curvatures.shape[-1]:
+        return np.broadcast_to(np.arange(curvatures.shape[-1]), curvatures.shape)
+    largest = np.argsort(-np.abs(curvatures), axis=-1, kind='stable')[..., :num_directions]
+    return np.sort(largest, axis=-1)
+
+
+def get_curvature(condition_zip, origin_indices, num_advs, num_iters, num_steps_per_iter, dtype, backend='autodiff',
+        num_lanczos=200, cache=None, keep_shape_operators=True, num_directions=None, directions_dtype=np.float64,
+        cache_filename=None):
     """
     A note on the gradient of the difference in activations:
     The gradient points in the direction of the origin from the boundary image.
     Therefore, for large enough eps, origin - eps * grad/|grad| will reach the boundary; and boundary + eps * grad/|grad| will reach the origin 
+
+    backend 'autodiff' computes the dense Hessian row by row, 'vmap' in vmap-batched chunks of rows and 'lanczos' only
+    the num_lanczos most extreme principal curvatures from Hessian-vector products (see hvp_curvature.py); the
+    remaining entries of the outputs stay NaN.
+
+    With a cache (a BoundaryCache), boundary images, gradients and Hessians (or Lanczos curvatures) are reused
+    across runs and run types.
+
+    Finished iterations are written to the CurvatureStore of cache_filename and skipped after a restart. Without
+    keep_shape_operators the (num_dims x num_dims) shape operators are neither kept nor stored and None is returned
+    in their place.
+
+    Only the principal directions of the num_directions largest |curvatures| (see retained_direction_indices) are
+    kept and stored as directions_dtype (e.g. np.float32 or np.float16), which makes the last axis of
+    principal_directions num_directions long. All principal curvatures are kept.
     """
-    cache_filename = os.environ.get("CACHEFILE")
+    store = get_curvature_store(cache_filename, {'principal_curvatures': 'principal_curvatures',
+        'principal_directions': 'principal_directions', 'shape_operators': 'shape_operator'})
     num_images = len(origin_indices)
     models, model_data = zip(*condition_zip)
     num_models = len(models)
     image_shape = model_data[0]['images'][0, ...][None, ...].shape
     image_size = np.prod(image_shape)
     num_dims = image_size - 1 #removes normal direction
-    if os.path.isfile(cache_filename):
-        with np.load(cache_filename) as data:
-            shape_operators = data['shape_operators']
-            principal_curvatures = data['principal_curvatures']
-            principal_directions = data['principal_directions']
-    else:
+    shape_operators = None
+    if keep_shape_operators:
         shape_operators = np.empty((num_models, num_images, num_advs, num_dims, num_dims)) * np.nan
-        principal_curvatures = np.empty((num_models, num_images, num_advs, num_dims)) * np.nan
-        principal_directions = np.empty((num_models, num_images, num_advs, image_size, num_dims)) * np.nan
+    principal_curvatures = np.empty((num_models, num_images, num_advs, num_dims)) * np.nan
+    num_kept_directions = num_dims if num_directions is None else min(num_directions, num_dims)
+    principal_directions = np.full((num_models, num_images, num_advs, image_size, num_kept_directions), np.nan,
+        dtype=directions_dtype)
     for model_idx, (model_, data_)  in enumerate(zip(models, model_data)):
         pbar = tqdm(total=num_advs*num_images, leave=True)
         for image_idx, origin_idx in enumerate(list(origin_indices)):
             clean_lbl = int(data_['labels'][origin_idx])
             for adv_idx in range(num_advs):
-                if not np.all(np.isnan(principal_curvatures[model_idx, image_idx, adv_idx, :])):
+                index = (model_idx, image_idx, adv_idx)
+                if store is not None and store.has(index):
+                    entry = store.load(index)
+                    k = entry['principal_curvatures'].shape[0]
+                    if keep_shape_operators and 'shape_operator' in entry:
+                        shape_operators[index][:k, :k] = entry['shape_operator']
+                    principal_curvatures[index][:k] = entry['principal_curvatures']
+                    directions = entry['principal_directions']
+                    if directions.shape[1] > num_kept_directions: # imported from an old CACHEFILE, with all directions
+                        directions = directions[:, retained_direction_indices(entry['principal_curvatures'],
+                            num_directions)]
+                    principal_directions[index][:, :directions.shape[1]] = directions
+                    pbar.update(1)
                     print(f'iteration {model_idx}:{len(models)}-{image_idx}:{len(list(origin_indices))}-{adv_idx}:{num_advs} done')
                     flush()
                     continue
                 else:
                     print(f'iteration {model_idx}:{len(models)}-{image_idx}:{len(list(origin_indices))}-{adv_idx}:{num_advs}')
                     flush()
-                boundary_image = get_paired_boundary_image(
+                boundary_image = cached_boundary_image(
                     model=model_,
                     origin=data_['images'][origin_idx, ...],
                     alt_image=data_['advs'][origin_idx, adv_idx, ...],
                     num_steps_per_iter=num_steps_per_iter,
-                    num_iters=num_iters
+                    num_iters=num_iters,
+                    cache=cache
                 )[0]
                 print('... boundary image found')
                 flush()
                 adv_lbl = int(data_['adv_class'][origin_idx, adv_idx])
-                def func(x):
-                    acts_diff = paired_activation(model_, x, clean_lbl, adv_lbl)
-                    return acts_diff
-                #hessian = torch.autograd.functional.hessian(func, torchify(boundary_image[None,...]))
-                hessian = torch_hessian(func, torchify(boundary_image[None,...]))
-                hessian = hessian.reshape((int(boundary_image.size), int(boundary_image.size))).type(dtype)
-                activation, gradient = paired_activation_and_gradient(model_, torchify(boundary_image[None, ...]), clean_lbl, adv_lbl)
-                gradient = gradient.reshape(-1).type(dtype)
-                curvature = curve_utils.local_response_curvature_level_set(gradient, hessian)
-                shape_operators[model_idx, image_idx, adv_idx, ...] = curvature[0].detach().cpu().numpy()
-                principal_curvatures[model_idx, image_idx, adv_idx, :] = curvature[1].detach().cpu().numpy()
-                principal_directions[model_idx, image_idx, adv_idx, ...] = curvature[2].detach().cpu().numpy()
+                if backend == 'lanczos':
+                    gradient, curvature = boundary_lanczos_curvature(model_, boundary_image, clean_lbl, adv_lbl,
+                        dtype, num_lanczos, cache=cache)
+                else:
+                    gradient, hessian = boundary_hessian(model_, boundary_image, clean_lbl, adv_lbl, dtype,
+                        vectorize=(backend == 'vmap'), cache=cache)
+                    curvature = curve_utils.local_response_curvature_level_set(gradient, hessian)
+                k = curvature[1].shape[0]
+                curvatures = curvature[1].detach().cpu().numpy()
+                kept = retained_direction_indices(curvatures, num_directions)
+                entry = {
+                    'principal_curvatures': curvatures,
+                    'principal_directions': curvature[2].detach().cpu().numpy()[:, kept].astype(directions_dtype),
+                }
+                if keep_shape_operators:
+                    entry['shape_operator'] = curvature[0].detach().cpu().numpy()
+                    shape_operators[index][:k, :k] = entry['shape_operator']
+                principal_curvatures[index][:k] = entry['principal_curvatures']
+                principal_directions[index][:, :len(kept)] = entry['principal_directions']
                 print('... curvature found')
                 flush()
                 #sleep(60)
-                np.savez(cache_filename,
-                    shape_operators=shape_operators,
-                    principal_curvatures=principal_curvatures,
-                    principal_directions=principal_directions
-                )
+                if store is not None:
+                    store.write(index, **entry)
                 pbar.update(1)
     pbar.close()
     return shape_operators, principal_curvatures, principal_directions
 
 
-def get_subspace_curvature(run_type, model, data, origin_indices, num_advs, num_steps_per_iter, num_iters, batch_size, dtype):
-    cache_filename = os.environ.get("CACHEFILE")
+def get_subspace_curvature(run_type, model, data, origin_indices, num_advs, num_steps_per_iter, num_iters, batch_size, dtype,
+        backend='autodiff', num_lanczos=200, cache=None, cache_filename=None):
+    """
+    backend 'autodiff' (or 'vmap', see get_curvature) projects the dense Hessian onto the subspace, 'lanczos' a rank
+    num_lanczos approximation of it built from Hessian-vector products (see hvp_curvature.py) and 'subspace'
+    computes the projection exactly from one Hessian-vector product per basis vector (num_advs backward passes
+    instead of one per pixel). cache and cache_filename as in get_curvature.
+    """
+    store = get_curvature_store(cache_filename, {'all_subspace_curvatures': 'curvatures', 'all_subspace_directions': 'directions'})
     num_exp_images = len(origin_indices)
     image_size = data['images'][0, ...].size
-    if os.path.isfile(cache_filename):
-        with np.load(cache_filename) as _data:
-            all_subspace_curvatures = _data['all_subspace_curvatures']
-            all_subspace_directions = _data['all_subspace_directions']
-    else:
-        all_subspace_curvatures = np.empty((num_exp_images, num_advs, num_advs)) * np.nan
-        all_subspace_directions = np.empty((num_exp_images, num_advs, image_size, num_advs)) * np.nan
+    all_subspace_curvatures = np.empty((num_exp_images, num_advs, num_advs)) * np.nan
+    all_subspace_directions = np.empty((num_exp_images, num_advs, image_size, num_advs)) * np.nan
     pbar = tqdm(total=num_advs*num_exp_images, leave=True)
     for image_idx, origin_idx in enumerate(list(origin_indices)):
         for adv_idx in range(num_advs):
-            if not np.all(np.isnan(all_subspace_curvatures[image_idx, adv_idx, :])):
+            index = (image_idx, adv_idx)
+            if store is not None and store.has(index):
+                entry = store.load(index)
+                all_subspace_curvatures[image_idx, adv_idx, :] = entry['curvatures']
+                all_subspace_directions[image_idx, adv_idx, ...] = entry['directions']
+                pbar.update(1)
                 print(f'iteration {image_idx}:{len(list(origin_indices))}-{adv_idx}:{num_advs} done')
                 flush()
                 continue
             else:
                 print(f'iteration {image_idx}:{len(list(origin_indices))}-{adv_idx}:{num_advs}')
                 flush()
-            boundary_image, boundary_dir, pert_length = get_paired_boundary_image(
+            boundary_image, boundary_dir, pert_length = cached_boundary_image(
                 model=model,
                 origin=data['images'][origin_idx, ...],
                 alt_image=data['advs'][origin_idx, adv_idx, ...],
                 num_steps_per_iter=num_steps_per_iter,
                 num_iters=num_iters,
-                batch_size=batch_size)
+                batch_size=batch_size,
+                cache=cache)
             print('... boundary image found')
             flush()
             clean_lbl = int(data['labels'][origin_idx])
             adv_lbl = int(data['adv_class'][origin_idx, adv_idx])
-            activation, gradient = paired_activation_and_gradient(model,
-                    torchify(boundary_image[None, ...]), clean_lbl, adv_lbl)
-            gradient = gradient.reshape(-1).type(dtype)
+            if backend == 'lanczos':
+                # the low rank factors of low_rank_hessian, from the (cached) Lanczos curvature
+                gradient, (_, curvatures, directions) = boundary_lanczos_curvature(model, boundary_image, clean_lbl,
+                    adv_lbl, dtype, num_lanczos, cache=cache)
+                hessian_factors = (directions, -curvatures * torch.linalg.norm(gradient))
+            elif backend == 'subspace':
+                def func(x):
+                    acts_diff = paired_activation(model, x, clean_lbl, adv_lbl)
+                    return acts_diff
+                gradient, hvp = hvp_utils.make_hvp(func, torchify(boundary_image[None,...]))
+                gradient = gradient.type(dtype)
+            else:
+                gradient, hessian = boundary_hessian(model, boundary_image, clean_lbl, adv_lbl, dtype,
+                    vectorize=(backend == 'vmap'), cache=cache)
             n_pixels = gradient.numel()
-            def func(x):
-                acts_diff = paired_activation(model, x, clean_lbl, adv_lbl)
-                return acts_diff
-            hessian = torch_hessian(func, torchify(boundary_image[None,...]))
-            hessian = hessian.reshape((int(boundary_image.size), int(boundary_image.size))).type(dtype)
             if run_type == 4 or run_type == 5: # random subspace
                 norm_gradient = (gradient / torch.linalg.norm(gradient)).detach().cpu().numpy()
                 projection_basis = torch.from_numpy(data_utils.get_rand_orth_vectors(norm_gradient,
@@ -293,16 +526,20 @@ def get_subspace_curvature(run_type, model, data, origin_indices, num_advs, num_
                 adv_dirs = data['dirs'][origin_idx, :num_advs+1, ...]
                 adv_dirs = np.delete(adv_dirs, adv_idx, axis=0).reshape(num_advs, n_pixels)
                 projection_basis = torch.from_numpy(adv_dirs).type(dtype).to(dev())
-            curvature = curve_utils.local_response_curvature_level_set(gradient, hessian,
-                    projection_subspace_of_interest=projection_basis)
+            if backend == 'lanczos':
+                curvature = hvp_utils.low_rank_subspace_curvature(hessian_factors, gradient, projection_basis)
+            elif backend == 'subspace':
+                curvature = hvp_utils.hvp_subspace_curvature(hvp, gradient, projection_basis)
+            else:
+                curvature = curve_utils.local_response_curvature_level_set(gradient, hessian,
+                        projection_subspace_of_interest=projection_basis)
             print('... curvature found')
             flush()
             all_subspace_curvatures[image_idx, adv_idx, :] = curvature[1].detach().cpu().numpy()
             all_subspace_directions[image_idx, adv_idx, ...] = curvature[2].detach().cpu().numpy()
-            np.savez(cache_filename,
-                all_subspace_curvatures=all_subspace_curvatures,
-                all_subspace_directions=all_subspace_directions,
-            )
+            if store is not None:
+                store.write(index, curvatures=all_subspace_curvatures[image_idx, adv_idx],
+                    directions=all_subspace_directions[image_idx, adv_idx])
             pbar.update(1)
     pbar.close()
     return all_subspace_curvatures, all_subspace_directions
@@ -345,8 +582,8 @@ def get_hessian_error(model, origin, clean_lbl, adv_lbl, abscissa, ordinate, hes
 
 def load_mnist(code_directory, seed):
     # load data
-    data_natural = np.load(code_directory+f'AdversarialDecomposition/data/natural_{seed}.npy', allow_pickle=True).item()
-    data_madry = np.load(code_directory+f'AdversarialDecomposition/data/robust_{seed}.npy', allow_pickle=True).item()
+    data_natural = load_result_dict(code_directory+f'AdversarialDecomposition/data/natural_{seed}.npy')
+    data_madry = load_result_dict(code_directory+f'AdversarialDecomposition/data/robust_{seed}.npy')
     # load models
     model_natural = model_loader.madry_diff()
     model_natural.load_state_dict(torch.load(
@@ -369,8 +606,8 @@ def load_cifar(code_directory):
     # load data
     #data_natural = np.load(code_directory+'AdversarialDecomposition/data/cifar_natural_diff.npy', allow_pickle=True).item()
     #data_madry = np.load(code_directory+'AdversarialDecomposition/data/cifar_robust_diff.npy', allow_pickle=True).item()
-    data_natural = np.load(code_directory+'AdversarialDecomposition/data/cifar_natural_wrn.npy', allow_pickle=True).item()
-    data_madry = np.load(code_directory+'AdversarialDecomposition/data/cifar_robust_wrn.npy', allow_pickle=True).item()
+    data_natural = load_result_dict(code_directory+'AdversarialDecomposition/data/cifar_natural_wrn.npy')
+    data_madry = load_result_dict(code_directory+'AdversarialDecomposition/data/cifar_robust_wrn.npy')
     # load models
     # natural
     ds = CIFAR(code_directory+'AdversarialDecomposition/data/cifar-10-batches-py')
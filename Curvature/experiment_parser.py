@@ -1,7 +1,10 @@
 import sys
 import os.path
+import json
+import shutil
 
-from curve_utils import load_mnist, load_cifar
+from curve_utils import load_mnist, load_cifar, retained_direction_indices
+from utils import open_memmap_field, load_memmap_dict
 
 import numpy as np
 
@@ -70,18 +73,26 @@ def get_index_data(dataset_type, run_type, num_images, num_advs, code_directory=
     return all_origin_indices_dict, adv_origin_indices_dict
 
 
-def get_experiment_outputs(dataset_type, run_type, image_index, code_directory='../../'):
+def get_filename_prefix(dataset_type, code_directory='../../'):
     filename_prefix = code_directory+'AdversarialDecomposition/data/'
-    dataset_prefix = get_dataset_prefix(dataset_type)
-    filename_prefix += f'{dataset_prefix}_batch/'
+    filename_prefix += f'{get_dataset_prefix(dataset_type)}_batch/'
     if not os.path.exists(filename_prefix):
         assert False, (f'ERROR: get_experiment_output: Directory {filename_prefix} not found.')
+    return filename_prefix
+
+
+def get_experiment_filename(dataset_type, run_type, image_index, code_directory='../../'):
+    dataset_prefix = get_dataset_prefix(dataset_type)
     run_name = get_run_name(run_type)
     if run_type <= 3: #mean curvature calculations
         filename_postfix = dataset_prefix+f'_{image_index:03d}_curvatures_and_directions_autodiff.npz'
     else: # subspace experiments
         filename_postfix = dataset_prefix+f'_{image_index:03d}_curvatures_autodiff.npz'
-    filename = filename_prefix + run_name + filename_postfix
+    return get_filename_prefix(dataset_type, code_directory) + run_name + filename_postfix
+
+
+def get_experiment_outputs(dataset_type, run_type, image_index, code_directory='../../'):
+    filename = get_experiment_filename(dataset_type, run_type, image_index, code_directory)
     experiment_dict = load_dictionary(filename)
     return experiment_dict
 
@@ -113,4 +124,99 @@ def get_combined_experiment_outputs(dataset_type, run_type, num_images, code_dir
         'principal_directions':principal_directions,
         'origin_indices':origin_indices,
     }
+    num_directions = principal_directions.shape[-1]
+    if run_type <= 3 and num_directions < principal_curvatures.shape[-1]: # saved with num_saved_directions
+        output_dict['principal_direction_indices'] = retained_direction_indices(principal_curvatures, num_directions)
     return output_dict
+
+
+def build_experiment_index(directory, filenames, fields, run_type):
+    """
+    Writes fields of the combined outputs of the files (one per image, see get_combined_experiment_outputs) to the
+    memory-mapped index directory. Only one output file is in memory at a time: a first pass collects the shapes,
+    a second one copies every field of an image straight into the padded memmap (padded with NaN for floats).
+    """
+    write_fields = [field for field in fields if field != 'principal_direction_indices']
+    read_fields = list(write_fields)
+    if 'principal_direction_indices' in fields:
+        write_fields = list(dict.fromkeys(write_fields + ['principal_curvatures']))
+        read_fields = list(dict.fromkeys(write_fields + ['principal_directions']))
+
+    def image_fields(filename, fields):
+        experiment_outputs = load_dictionary(filename)
+        return {field: np.asarray(experiment_outputs[field][0] if field == 'origin_indices'
+                                  else np.squeeze(experiment_outputs[field])) for field in fields}
+
+    shapes = {field: [] for field in read_fields}
+    dtypes = {}
+    for filename in filenames:
+        for field, value in image_fields(filename, read_fields).items():
+            shapes[field].append(value.shape)
+            dtypes[field] = value.dtype
+    max_shapes = {field: tuple(np.max(np.array(field_shapes), axis=0)) if field_shapes[0] else ()
+                  for field, field_shapes in shapes.items()}
+
+    arrays = {}
+    for field in write_fields:
+        fill = np.nan if np.issubdtype(dtypes[field], np.floating) else None
+        arrays[field] = open_memmap_field(directory, field, dtypes[field], (len(filenames),) + max_shapes[field],
+                                          fill)
+    for image_index, filename in enumerate(filenames):
+        for field, value in image_fields(filename, write_fields).items():
+            arrays[field][(image_index,) + tuple(slice(0, n) for n in value.shape)] = value
+    for array in arrays.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    if 'principal_direction_indices' in fields:
+        curvatures = arrays['principal_curvatures']
+        num_directions = max_shapes['principal_directions'][-1]
+        if run_type <= 3 and num_directions < curvatures.shape[-1]: # saved with num_saved_directions
+            indices = retained_direction_indices(curvatures, num_directions)
+            array = open_memmap_field(directory, 'principal_direction_indices', indices.dtype, indices.shape)
+            array[...] = indices
+            array.flush()
+
+
+def get_indexed_experiment_outputs(dataset_type, run_type, num_images, fields=None, code_directory='../../'):
+    """
+    Memory-mapped version of get_combined_experiment_outputs. The requested fields of the combined outputs of the
+    run type are written once to an index directory (see build_experiment_index), together with a manifest of the
+    output files they were built from, and rebuilt when one of those changed. Afterwards nothing is read from disk
+    until a field is indexed.
+    fields selects the returned fields (all for None), e.g. ['principal_curvatures']; fields that are not requested
+    are not built, so e.g. the principal directions are never read for curvature plots.
+    """
+    dataset_prefix = get_dataset_prefix(dataset_type)
+    directory = (get_filename_prefix(dataset_type, code_directory) + get_run_name(run_type) + dataset_prefix
+        + f'_{num_images}image_index')
+    filenames = []
+    manifest = {}
+    for image_index in range(num_images):
+        filename = get_experiment_filename(dataset_type, run_type, image_index, code_directory)
+        if not os.path.exists(filename):
+            assert False, (f'ERROR: get_indexed_experiment_outputs: File {filename} not found.')
+        filenames.append(filename)
+        manifest[filename] = os.path.getmtime(filename)
+    manifest_filename = os.path.join(directory, 'manifest.json')
+    index_manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            index_manifest = json.load(f)
+    if index_manifest.get('files') != manifest:
+        # the outputs changed, all fields are stale
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        index_manifest = {'files': manifest, 'fields': []}
+
+    all_fields = ['origin_indices', 'principal_curvatures', 'principal_directions', 'principal_direction_indices']
+    missing = [field for field in (all_fields if fields is None else fields) if field not in index_manifest['fields']]
+    if missing:
+        build_experiment_index(directory, filenames, missing, run_type)
+        index_manifest['fields'] += missing
+        with open(manifest_filename, 'w') as f:
+            json.dump(index_manifest, f, indent=1)
+    outputs = load_memmap_dict(directory)
+    if fields is not None:
+        outputs = {field: outputs[field] for field in fields}
+    return outputs
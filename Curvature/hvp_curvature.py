@@ -0,0 +1,139 @@
+"""
+Hessian-free curvature of the level set {x | f(x) = f(x_0)} of a scalar function f.
+
+The shape operator of the level set at x_0 is S = -P H P / |g|, with the gradient g, the Hessian H and the projection
+P = I - n n^T onto the tangent space (n = g / |g|). Instead of building the dense n x n Hessian, everything here only
+uses Hessian-vector products (one double backward pass each), so memory is O(n k) for k directions.
+"""
+
+import torch
+
+
+def make_hvp(func, x):
+    """
+    Returns the gradient of func at x and a function computing Hessian-vector products H v for flat vectors v.
+    func has to map x to a single element tensor.
+    """
+    x = x.detach().clone().requires_grad_(True)
+    value = func(x).sum()
+    gradient, = torch.autograd.grad(value, x, create_graph=True)
+
+    def hvp(v):
+        hv, = torch.autograd.grad(gradient, x, grad_outputs=v.reshape(x.shape).to(gradient), retain_graph=True)
+        return hv.reshape(-1).detach()
+
+    return gradient.reshape(-1).detach(), hvp
+
+
+def shape_operator_fn(hvp, gradient):
+    """
+    Returns v -> S v = -P H P v / |g| for the level set with the given gradient.
+    """
+    grad_norm = torch.linalg.norm(gradient)
+    normal = gradient / grad_norm
+
+    def project(v):
+        return v - (normal @ v) * normal
+
+    def shape_operator(v):
+        return -project(hvp(project(v))) / grad_norm
+
+    return shape_operator, project
+
+
+def lanczos(matvec, v0, num_iters):
+    """
+    Lanczos iteration with full reorthogonalization for a symmetric operator.
+    Returns the eigenvalues and eigenvectors (as columns) of the tridiagonal matrix T and the Lanczos basis Q
+    (n x m), such that Q T Q^T approximates the operator on the Krylov space; m <= num_iters if the Krylov space
+    is exhausted early.
+    """
+    n = v0.numel()
+    Q = torch.zeros((num_iters + 1, n), dtype=v0.dtype, device=v0.device)
+    alpha = torch.zeros(num_iters, dtype=v0.dtype, device=v0.device)
+    beta = torch.zeros(num_iters, dtype=v0.dtype, device=v0.device)
+    Q[0] = v0 / torch.linalg.norm(v0)
+    m = num_iters
+    for j in range(num_iters):
+        w = matvec(Q[j])
+        alpha[j] = Q[j] @ w
+        for _ in range(2):
+            w = w - Q[:j + 1].T @ (Q[:j + 1] @ w)
+        beta[j] = torch.linalg.norm(w)
+        if beta[j] < 1e-10 * torch.abs(alpha[:j + 1]).max():
+            m = j + 1
+            break
+        Q[j + 1] = w / beta[j]
+    T = torch.diag(alpha[:m]) + torch.diag(beta[:m - 1], 1) + torch.diag(beta[:m - 1], -1)
+    evals, evecs = torch.linalg.eigh(T)
+    return T, evals, evecs, Q[:m].T
+
+
+def lanczos_level_set_curvature(hvp, gradient, num_directions, seed=None):
+    """
+    Principal curvatures of the level set from num_directions Lanczos steps on the shape operator, started from a
+    random tangent vector. The Ritz values converge to the most extreme (largest |curvature|) principal curvatures
+    first.
+    Returns the tridiagonal shape operator T (m x m, in the Lanczos basis), the principal curvatures (m,) in
+    descending order and the principal directions (n x m), like local_response_curvature_level_set.
+    """
+    shape_operator, project = shape_operator_fn(hvp, gradient)
+    generator = None if seed is None else torch.Generator(device=gradient.device).manual_seed(seed)
+    v0 = project(torch.randn(gradient.shape, dtype=gradient.dtype, device=gradient.device, generator=generator))
+    num_directions = min(num_directions, gradient.numel() - 1)
+    T, evals, evecs, Q = lanczos(shape_operator, v0, num_directions)
+    order = torch.argsort(evals, descending=True)
+    return T, evals[order], Q @ evecs[:, order]
+
+
+def low_rank_hessian(hvp, gradient, num_directions, seed=None):
+    """
+    Rank num_directions approximation V diag(w) V^T of the tangent space Hessian P H P from Lanczos, to be used in
+    place of the dense Hessian (only O(n k) memory).
+    Returns the factors (V (n x m), w (m,)).
+    """
+    grad_norm = torch.linalg.norm(gradient)
+    T, curvatures, directions = lanczos_level_set_curvature(hvp, gradient, num_directions, seed)
+    return directions, -curvatures * grad_norm
+
+
+def subspace_level_set_curvature(projected_hessian, gradient, basis):
+    """
+    Curvature of the level set restricted to the span of basis (k x n, orthonormal rows), from the projected
+    tangent space Hessian B P H P B^T (k x k).
+    Returns the shape operator in the basis, the principal curvatures (k,) in descending order and the principal
+    directions (n x k).
+    """
+    shape_operator = -projected_hessian / torch.linalg.norm(gradient)
+    shape_operator = (shape_operator + shape_operator.T) / 2
+    evals, evecs = torch.linalg.eigh(shape_operator)
+    order = torch.argsort(evals, descending=True)
+    return shape_operator, evals[order], basis.T @ evecs[:, order]
+
+
+def low_rank_subspace_curvature(factors, gradient, basis):
+    """
+    subspace_level_set_curvature with the Hessian given by the low_rank_hessian factors.
+    """
+    V, w = factors
+    normal = gradient / torch.linalg.norm(gradient)
+    projected_basis = basis - (basis @ normal)[:, None] * normal[None]
+    BV = projected_basis @ V
+    return subspace_level_set_curvature(BV @ torch.diag(w) @ BV.T, gradient, basis)
+
+
+def projected_hessian(hvp, gradient, basis):
+    """
+    B P H P B^T (k x k) for the basis B (k x n) from k Hessian-vector products along the projected basis vectors.
+    """
+    normal = gradient / torch.linalg.norm(gradient)
+    projected_basis = basis - (basis @ normal)[:, None] * normal[None]
+    hessian_basis = torch.stack([hvp(b) for b in projected_basis], dim=0).to(basis)
+    return projected_basis @ hessian_basis.T
+
+
+def hvp_subspace_curvature(hvp, gradient, basis):
+    """
+    subspace_level_set_curvature with the projected Hessian computed exactly from k Hessian-vector products.
+    """
+    return subspace_level_set_curvature(projected_hessian(hvp, gradient, basis), gradient, basis)
@@ -76,20 +76,18 @@ else: # CIFAR
     data_name = 'cifar'
 
 def load_runs(dataset_type, num_images):
+    # only the fields used below are indexed and loaded, the pair runs do not need their principal directions
+    curvature_fields = ['principal_curvatures', 'origin_indices']
     run_outputs = []
     for run_type in range(2):
-        run_outputs.append(exp.get_combined_experiment_outputs(dataset_type, run_type, num_images))
-        if 'data' in run_outputs[-1].keys():
-            del run_outputs[-1]['data']
-    exp_num_images, num_advs, num_pixels, num_directions = run_outputs[0]['principal_directions'].shape
+        run_outputs.append(exp.get_indexed_experiment_outputs(dataset_type, run_type, num_images,
+                                                              fields=curvature_fields))
+    exp_num_images, num_advs = run_outputs[0]['principal_curvatures'].shape[:2]
     assert exp_num_images == num_images
 
     paired_principal_curvatures = np.stack([
         run_outputs[0]['principal_curvatures'], # natural, dataset pair
         run_outputs[1]['principal_curvatures']], axis=0) # robust, dataset pair
-    paired_principal_directions = np.stack([
-        run_outputs[0]['principal_directions'], # natural, dataset pair
-        run_outputs[1]['principal_directions']], axis=0) # robust, dataset pair
     paired_mean_curvatures = np.mean(paired_principal_curvatures, axis=-1)
     paired_origin_indices = np.stack([
         run_outputs[0]['origin_indices'], # natural, dataset pair
@@ -97,54 +95,51 @@ def load_runs(dataset_type, num_images):
 
     run_outputs = []
     for run_type in range(2, 4):
-        run_outputs.append(exp.get_combined_experiment_outputs(dataset_type, run_type, num_images))
-        if 'data' in run_outputs[-1].keys():
-            del run_outputs[-1]['data']
+        run_outputs.append(exp.get_indexed_experiment_outputs(dataset_type, run_type, num_images,
+                                                              fields=curvature_fields))
 
     adv_principal_curvatures = np.stack([
         run_outputs[0]['principal_curvatures'], # natural, adversarial pair
         run_outputs[1]['principal_curvatures']], axis=0) # robust, adversarial pair
-    adv_principal_directions = np.stack([
-        run_outputs[0]['principal_directions'], # natural, adversarial pair
-        run_outputs[1]['principal_directions']], axis=0) # robust, adversarial pair
     adv_mean_curvatures = np.mean(adv_principal_curvatures, axis=-1)
     adv_origin_indices = np.stack([
         run_outputs[0]['origin_indices'], # natural, adversarial pair
         run_outputs[1]['origin_indices']], axis=0) #robust, adversarial pair
 
+    # the subspace directions are only checked for failed images, they stay memory-mapped (one array per model)
+    # and are read one image at a time
+    subspace_fields = ['principal_curvatures', 'principal_directions']
     run_outputs = []
     for run_type in range(4, 6):
-        run_outputs.append(exp.get_combined_experiment_outputs(dataset_type, run_type, num_images))
-        if 'data' in run_outputs[-1].keys():
-            del run_outputs[-1]['data']
+        run_outputs.append(exp.get_indexed_experiment_outputs(dataset_type, run_type, num_images,
+                                                              fields=subspace_fields))
     rand_subspace_pcs = np.stack([
         run_outputs[0]['principal_curvatures'], # natural, random subspace
         run_outputs[1]['principal_curvatures']], axis=0) # robust, random subspace
-    rand_subspace_pds = np.stack([
+    rand_subspace_pds = [
         run_outputs[0]['principal_directions'], # natural, random subspace
-        run_outputs[1]['principal_directions']], axis=0) # robust, random subspace
+        run_outputs[1]['principal_directions']] # robust, random subspace
 
     run_outputs = []
     for run_type in range(6, 8):
-        run_outputs.append(exp.get_combined_experiment_outputs(dataset_type, run_type, num_images))
-        if 'data' in run_outputs[-1].keys():
-            del run_outputs[-1]['data']
+        run_outputs.append(exp.get_indexed_experiment_outputs(dataset_type, run_type, num_images,
+                                                              fields=subspace_fields))
     adv_subspace_pcs = np.stack([
         run_outputs[0]['principal_curvatures'], # natural, adversarial subspace
         run_outputs[1]['principal_curvatures']], axis=0) # robust, adversarial subspace
-    adv_subspace_pds = np.stack([
+    adv_subspace_pds = [
         run_outputs[0]['principal_directions'], # natural, adversarial subspace
-        run_outputs[1]['principal_directions']], axis=0) # robust, adversarial subspace
+        run_outputs[1]['principal_directions']] # robust, adversarial subspace
     output = (
-        paired_principal_curvatures, paired_principal_directions, paired_mean_curvatures, paired_origin_indices,
-        adv_principal_curvatures, adv_principal_directions, adv_mean_curvatures, adv_origin_indices,
+        paired_principal_curvatures, paired_mean_curvatures, paired_origin_indices,
+        adv_principal_curvatures, adv_mean_curvatures, adv_origin_indices,
         rand_subspace_pcs, rand_subspace_pds, adv_subspace_pcs, adv_subspace_pds)
     return output
 
-(paired_principal_curvatures, paired_principal_directions, paired_mean_curvatures, paired_origin_indices,
-    adv_principal_curvatures, adv_principal_directions, adv_mean_curvatures, adv_origin_indices,
+(paired_principal_curvatures, paired_mean_curvatures, paired_origin_indices,
+    adv_principal_curvatures, adv_mean_curvatures, adv_origin_indices,
     rand_subspace_pcs, rand_subspace_pds, adv_subspace_pcs, adv_subspace_pds) = load_runs(dataset_type, num_images)
-num_models, exp_num_images, num_advs, num_pixels, num_directions = paired_principal_directions.shape
+num_models, exp_num_images, num_advs = paired_principal_curvatures.shape[:3]
 
 
 # In[ ]:
@@ -297,15 +292,13 @@ for image_idx in range(num_images):
             or
             np.any(np.isnan(adv_subspace_pcs[:, image_idx, ...]))
             or
-            np.any(np.isnan(rand_subspace_pds[:, image_idx, ...]))
+            any(np.any(np.isnan(pds[image_idx, ...])) for pds in rand_subspace_pds)
             or
-            np.any(np.isnan(adv_subspace_pds[:, image_idx, ...]))
+            any(np.any(np.isnan(pds[image_idx, ...])) for pds in adv_subspace_pds)
            ):
         bad_images.append(image_idx)
 rand_subspace_pcs = np.delete(rand_subspace_pcs, bad_images, axis=1)
 adv_subspace_pcs = np.delete(adv_subspace_pcs, bad_images, axis=1)
-rand_subspace_pds = np.delete(rand_subspace_pds, bad_images, axis=1)
-adv_subspace_pds = np.delete(rand_subspace_pds, bad_images, axis=1)
 
 
 # In[ ]:
@@ -1,3 +1,4 @@
+# to run all run types and images of a dataset in one job with a single model load: python curvature_driver.py dataset_type [n_workers]
 #for i in {0..1}
 #do
     for j in {0..7}
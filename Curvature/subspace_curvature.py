@@ -10,6 +10,7 @@ sys.path.insert(0, '../data')
 
 from utils import dev
 from curve_utils import *
+from boundary_cache import BoundaryCache
 
 sys.path.insert(0, './../..')
 
@@ -17,45 +18,60 @@ import response_contour_analysis.utils.dataset_generation as data_utils
 import response_contour_analysis.utils.model_handling as model_utils
 import response_contour_analysis.utils.principal_curvature as curve_utils
 
-if __name__ == "__main__":
-    """
-    dataset_type
-        0 - MNIST
-        1 - CIFAR
+"""
+dataset_type
+    0 - MNIST
+    1 - CIFAR
 
-    run_type
-        0 - natural, paired boundary
-        1 - robust, paired boundary
+run_type
+    0 - natural, paired boundary
+    1 - robust, paired boundary
 
-        2 - natural, adversarial boundary
-        3 - robust, adversarial boundary
+    2 - natural, adversarial boundary
+    3 - robust, adversarial boundary
 
-        4 - natural, random subspace
-        5 - robust, random subspace
+    4 - natural, random subspace
+    5 - robust, random subspace
 
-        6 - natural, adversarial subspace
-        7 - robust, adversarial subspace
-    """
-    print(dev())
-    cache_filename1 = os.environ.get("CACHEFILE")
-    print(f'Cache file = {cache_filename1}')
+    6 - natural, adversarial subspace
+    7 - robust, adversarial subspace
+"""
 
-    dataset_type = int(sys.argv[1])
-    run_type = int(sys.argv[2])
-    image_index = int(sys.argv[3])
+code_directory = '../../'
+
+batch_size = 10
+num_images = 10#50
+num_advs = 8#10
+seed = 0
+
+num_iters = 1 # for paired image boundary search
+num_steps_per_iter = 10#100 # for paired image boundary search
+dtype = torch.double
+curvature_backend = 'autodiff' # 'autodiff' (dense Hessian), 'vmap' (dense Hessian, vmap-batched rows) or 'lanczos' (Hessian-vector products)
+subspace_backend = 'autodiff' # run types 4-7: 'autodiff', 'vmap', 'lanczos' or 'subspace' (exact, num_advs Hessian-vector products)
+num_lanczos = 200 # number of Lanczos directions for the 'lanczos' backend
+num_saved_directions = None # run types 0-3: only save the principal directions of the largest |curvatures| (None saves all)
+directions_dtype = np.float64 # run types 0-3: e.g. np.float32 or np.float16 to save disk space and memory
 
-    code_directory = '../../'
-    filename_prefix = code_directory+'AdversarialDecomposition/data/'
 
-    batch_size = 10
-    num_images = 10#50
-    num_advs = 8#10
-    seed = 0
+def get_boundary_cache():
+    """
+    The BoundaryCache of the BOUNDARY_CACHE environment variable (boundary images and Hessians shared between run
+    types, see boundary_cache.py), or None.
+    """
+    boundary_cache_dir = os.environ.get("BOUNDARY_CACHE")
+    print(f'Boundary cache = {boundary_cache_dir}')
+    if boundary_cache_dir is None:
+        return None
+    return BoundaryCache(boundary_cache_dir, max_bytes=int(float(os.environ.get("BOUNDARY_CACHE_GB", 10)) * 2**30))
 
-    num_iters = 1 # for paired image boundary search
-    num_steps_per_iter = 10#100 # for paired image boundary search
-    dtype = torch.double
 
+def load_experiment(dataset_type):
+    """
+    Loads the models and data of a dataset and the origin indices of the experiments (computed and saved on first
+    use). Returns a dict, which is shared by all run types and image indices.
+    """
+    filename_prefix = code_directory+'AdversarialDecomposition/data/'
     if dataset_type == 0: # MNIST
         model_natural, data_natural, model_robust, data_robust = load_mnist(code_directory, seed)
         data_prefix = 'mnist'
@@ -86,112 +102,165 @@ if __name__ == "__main__":
             'robust_valid':all_robust_valid_indices
         })
     print('Data and models loaded')
+    return {
+        'filename_prefix': filename_prefix,
+        'data_prefix': data_prefix,
+        'model_natural': model_natural,
+        'data_natural': data_natural,
+        'model_robust': model_robust,
+        'data_robust': data_robust,
+        'all_natural_origin_indices': all_natural_origin_indices,
+        'all_natural_valid_indices': all_natural_valid_indices,
+        'all_robust_origin_indices': all_robust_origin_indices,
+        'all_robust_valid_indices': all_robust_valid_indices,
+    }
 
-    if run_type <= 3: #mean curvature calculations
-        # need to make a new subset of indices that also have enough valid adversarial examples
-        adv_image_index_filename = filename_prefix+data_prefix+f'_{num_images}image_{num_advs}adv_indices.npz'
-        if os.path.exists(adv_image_index_filename):
-            index_dict = np.load(adv_image_index_filename, allow_pickle=True)['data'].item()
-            data_natural_paired = index_dict['data_natural_paired']
-            data_robust_paired = index_dict['data_robust_paired']
-            paired_natural_adv_origin_indices = index_dict['paired_natural_adv_origin']
-            paired_robust_adv_origin_indices = index_dict['paired_robust_adv_origin']
-            natural_adv_origin_indices = index_dict['natural_adv_origin']
-            robust_adv_origin_indices = index_dict['robust_adv_origin']
-        else:
-            data_natural_paired = generate_paired_dict(model_natural, data_natural, all_natural_origin_indices,
-                                         all_natural_valid_indices, num_images, num_advs, num_steps_per_iter=num_steps_per_iter, num_iters=num_iters)
-            data_robust_paired = generate_paired_dict(model_robust, data_robust, all_robust_origin_indices,
-                                         all_robust_valid_indices, num_images, num_advs, num_steps_per_iter, num_iters)
-            paired_natural_adv_origin_indices = get_origin_indices(model_natural, data_natural_paired, num_images, num_advs, batch_size)[0]
-            paired_robust_adv_origin_indices = get_origin_indices(model_robust, data_robust_paired, num_images, num_advs, batch_size)[0]
-            natural_adv_origin_indices = get_origin_indices(model_natural, data_natural, num_images, num_advs, batch_size)[0]
-            robust_adv_origin_indices = get_origin_indices(model_robust, data_robust, num_images, num_advs, batch_size)[0]
-            np.savez(adv_image_index_filename, data={
-                'data_natural_paired':data_natural_paired,
-                'data_robust_paired':data_robust_paired,
-                'paired_natural_adv_origin':paired_natural_adv_origin_indices,
-                'paired_robust_adv_origin':paired_robust_adv_origin_indices,
-                'natural_adv_origin':natural_adv_origin_indices,
-                'robust_adv_origin':robust_adv_origin_indices
-            })
-        print('Generated paired data')
 
-        filename_postfix = data_prefix+f'_{image_index:03d}_curvatures_and_directions_autodiff.npz'
+def load_paired_indices(experiment):
+    """
+    Adds the paired data and the origin indices with enough valid adversarial examples (run types 0-3) to experiment,
+    computed and saved on first use.
+    """
+    if 'data_natural_paired' in experiment:
+        return experiment
+    filename_prefix = experiment['filename_prefix']
+    data_prefix = experiment['data_prefix']
+    model_natural, data_natural = experiment['model_natural'], experiment['data_natural']
+    model_robust, data_robust = experiment['model_robust'], experiment['data_robust']
+    # need to make a new subset of indices that also have enough valid adversarial examples
+    adv_image_index_filename = filename_prefix+data_prefix+f'_{num_images}image_{num_advs}adv_indices.npz'
+    if os.path.exists(adv_image_index_filename):
+        index_dict = np.load(adv_image_index_filename, allow_pickle=True)['data'].item()
+    else:
+        data_natural_paired = generate_paired_dict(model_natural, data_natural, experiment['all_natural_origin_indices'],
+                                     experiment['all_natural_valid_indices'], num_images, num_advs, num_steps_per_iter=num_steps_per_iter, num_iters=num_iters)
+        data_robust_paired = generate_paired_dict(model_robust, data_robust, experiment['all_robust_origin_indices'],
+                                     experiment['all_robust_valid_indices'], num_images, num_advs, num_steps_per_iter, num_iters)
+        index_dict = {
+            'data_natural_paired':data_natural_paired,
+            'data_robust_paired':data_robust_paired,
+            'paired_natural_adv_origin':get_origin_indices(model_natural, data_natural_paired, num_images, num_advs, batch_size)[0],
+            'paired_robust_adv_origin':get_origin_indices(model_robust, data_robust_paired, num_images, num_advs, batch_size)[0],
+            'natural_adv_origin':get_origin_indices(model_natural, data_natural, num_images, num_advs, batch_size)[0],
+            'robust_adv_origin':get_origin_indices(model_robust, data_robust, num_images, num_advs, batch_size)[0]
+        }
+        np.savez(adv_image_index_filename, data=index_dict)
+    print('Generated paired data')
+    experiment.update(index_dict)
+    return experiment
+
+
+def select_run(experiment, run_type, image_index):
+    """
+    Returns the model, the data, the origin indices and the name of the experiment (run_type, image_index).
+    """
+    if run_type <= 3: #mean curvature calculations
+        load_paired_indices(experiment)
         if run_type == 0: # natural, paired
-            data_ = data_natural_paired
-            model_ = model_natural
+            data_ = experiment['data_natural_paired']
+            model_ = experiment['model_natural']
+            condition_origin_indices = experiment['paired_natural_adv_origin']
             run_name = 'natural_paired_'
 
         elif run_type == 1: # robust, paired
-            data_ = data_robust_paired
-            model_ = model_robust
+            data_ = experiment['data_robust_paired']
+            model_ = experiment['model_robust']
+            condition_origin_indices = experiment['paired_robust_adv_origin']
             run_name = 'robust_paired_'
 
         elif run_type == 2: # natural, adversarial
-            data_ = data_natural
-            model_ = model_natural
+            data_ = experiment['data_natural']
+            model_ = experiment['model_natural']
+            condition_origin_indices = experiment['natural_adv_origin']
             run_name = 'natural_adv_'
 
         elif run_type == 3: # robust, adversarial
-            data_ = data_robust
-            model_ = model_robust
+            data_ = experiment['data_robust']
+            model_ = experiment['model_robust']
+            condition_origin_indices = experiment['robust_adv_origin']
             run_name = 'robust_adv_'
-        print('experiment ' + run_name)
-
-        if run_type == 0: # natural, paired condition
-            condition_origin_indices = paired_natural_adv_origin_indices
-        elif run_type == 1: # robust, paired condition
-            condition_origin_indices = paired_robust_adv_origin_indices
-        elif run_type == 2: # natural, adversarial condition
-            condition_origin_indices = natural_adv_origin_indices
-        elif run_type == 3: # robust, adversarial condition
-            condition_origin_indices = robust_adv_origin_indices
-
-        condition_zip = zip([model_], [data_])
-        shape_operators, principal_curvatures, principal_directions = get_curvature(
-            condition_zip, [condition_origin_indices[image_index]], num_advs, num_iters, num_steps_per_iter, dtype)
-
-        save_dict = {}
-        save_dict['origin_indices'] = [condition_origin_indices[image_index]]
-        #save_dict['shape_operators'] = shape_operators
-        save_dict['principal_curvatures'] = principal_curvatures
-        save_dict['principal_directions'] = principal_directions
-
 
     else: # subspace experiments
-        filename_postfix = data_prefix+f'_{image_index:03d}_curvatures_autodiff.npz'
-
         if run_type == 4: # natural, random
-            origin_indices = [all_natural_origin_indices[image_index]]
-            model_ = model_natural
-            data_ = data_natural
+            condition_origin_indices = experiment['all_natural_origin_indices']
+            model_ = experiment['model_natural']
+            data_ = experiment['data_natural']
             run_name = 'natural_rand_subspace_'
         elif run_type == 5: # robust, random
-            origin_indices = [all_robust_origin_indices[image_index]]
-            model_ = model_robust
-            data_ = data_robust
+            condition_origin_indices = experiment['all_robust_origin_indices']
+            model_ = experiment['model_robust']
+            data_ = experiment['data_robust']
             run_name = 'robust_rand_subspace_'
         elif run_type == 6: # natural, adversarial
-            origin_indices = [all_natural_origin_indices[image_index]]
-            model_ = model_natural
-            data_ = data_natural
+            condition_origin_indices = experiment['all_natural_origin_indices']
+            model_ = experiment['model_natural']
+            data_ = experiment['data_natural']
             run_name = 'natural_adv_subspace_'
         elif run_type == 7: # robust, adversarial
-            origin_indices = [all_robust_origin_indices[image_index]]
-            model_ = model_robust
-            data_ = data_robust
+            condition_origin_indices = experiment['all_robust_origin_indices']
+            model_ = experiment['model_robust']
+            data_ = experiment['data_robust']
             run_name = 'robust_adv_subspace_'
-        print(f'experiment {run_name}')
+    return model_, data_, [condition_origin_indices[image_index]], run_name
+
+
+def output_filename(experiment, run_type, image_index):
+    run_name = select_run(experiment, run_type, image_index)[3]
+    data_prefix = experiment['data_prefix']
+    if run_type <= 3:
+        filename_postfix = data_prefix+f'_{image_index:03d}_curvatures_and_directions_autodiff.npz'
+    else:
+        filename_postfix = data_prefix+f'_{image_index:03d}_curvatures_autodiff.npz'
+    return experiment['filename_prefix'] + run_name + filename_postfix
+
+
+def run_experiment(experiment, run_type, image_index, boundary_cache=None, cache_filename=None):
+    """
+    Computes the curvatures of the experiment (run_type, image_index) and saves them to output_filename.
+    Finished iterations are kept in the CurvatureStore of cache_filename (see get_curvature_store), if given.
+    """
+    model_, data_, origin_indices, run_name = select_run(experiment, run_type, image_index)
+    print('experiment ' + run_name)
+    if run_type <= 3: #mean curvature calculations
+        condition_zip = zip([model_], [data_])
+        shape_operators, principal_curvatures, principal_directions = get_curvature(
+            condition_zip, origin_indices, num_advs, num_iters, num_steps_per_iter, dtype,
+            backend=curvature_backend, num_lanczos=num_lanczos, cache=boundary_cache,
+            keep_shape_operators=False, # the shape operators are not saved
+            num_directions=num_saved_directions, directions_dtype=directions_dtype, cache_filename=cache_filename)
+
+        save_dict = {}
+        save_dict['origin_indices'] = origin_indices
+        #save_dict['shape_operators'] = shape_operators
+        save_dict['principal_curvatures'] = principal_curvatures
+        save_dict['principal_directions'] = principal_directions
 
+    else: # subspace experiments
         all_subspace_curvatures, all_subspace_directions = get_subspace_curvature(run_type, model_,
-                data_, origin_indices, num_advs, num_steps_per_iter, num_iters, batch_size, dtype)
+                data_, origin_indices, num_advs, num_steps_per_iter, num_iters, batch_size, dtype,
+                backend=subspace_backend, num_lanczos=num_lanczos, cache=boundary_cache,
+                cache_filename=cache_filename)
 
         save_dict = {}
         save_dict['origin_indices'] = origin_indices
         save_dict['principal_curvatures'] = all_subspace_curvatures
         save_dict['principal_directions'] = all_subspace_directions
 
-    filename = filename_prefix + run_name + filename_postfix
+    filename = output_filename(experiment, run_type, image_index)
     np.savez(filename, data=save_dict)
     print(f'output saved to {filename}')
+    return filename
+
+
+if __name__ == "__main__":
+    print(dev())
+    cache_filename1 = os.environ.get("CACHEFILE")
+    print(f'Cache file = {cache_filename1}')
+    boundary_cache = get_boundary_cache()
+
+    dataset_type = int(sys.argv[1])
+    run_type = int(sys.argv[2])
+    image_index = int(sys.argv[3])
+
+    experiment = load_experiment(dataset_type)
+    run_experiment(experiment, run_type, image_index, boundary_cache, cache_filename=cache_filename1)
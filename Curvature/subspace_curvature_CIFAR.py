@@ -10,7 +10,7 @@ sys.path.insert(0, './..')
 sys.path.insert(0, '../data')
 
 from models import model as model_loader
-from utils import dev, make_orth_basis
+from utils import dev, make_orth_basis, load_result_dict
 from robustness1.datasets import CIFAR
 from curve_utils import *
 
@@ -48,8 +48,8 @@ if __name__ == "__main__":
     dtype = torch.double
 
     # load data
-    data_natural = np.load(code_directory+'AdversarialDecomposition/data/cifar_natural_diff.npy', allow_pickle=True).item()
-    data_madry = np.load(code_directory+'AdversarialDecomposition/data/cifar_robust_diff.npy', allow_pickle=True).item()
+    data_natural = load_result_dict(code_directory+'AdversarialDecomposition/data/cifar_natural_diff.npy')
+    data_madry = load_result_dict(code_directory+'AdversarialDecomposition/data/cifar_robust_diff.npy')
 
     # load models
     ds = CIFAR(code_directory+'AdversarialDecomposition/data/cifar-10-batches-py')
@@ -176,7 +176,8 @@ if __name__ == "__main__":
                 if run_type == 4 or run_type == 5: # random subspace
                     dirs = [(gradient / torch.linalg.norm(gradient)).detach().cpu().numpy()]
                     n_iterations = 3
-                    random_basis = torch.from_numpy(make_orth_basis(dirs, n_pixels, n_iterations)[:subspace_size, :]).type(dtype).to(dev())
+                    random_basis = torch.from_numpy(make_orth_basis(dirs, n_pixels, n_iterations,
+                        n_vectors=subspace_size)).type(dtype).to(dev())
                     curvature = curve_utils.local_response_curvature_isoresponse_surface(gradient, hessian, projection_subspace_of_interest=random_basis)
                     rand_subspace_curvatures = curvature[1].detach().cpu().numpy()
                     all_subspace_curvatures[image_idx, :] = rand_subspace_curvatures
@@ -1,5 +1,8 @@
 from typing import Union, Tuple, Any, Optional
+import warnings
 import numpy as np
+import scipy.sparse
+import torch
 import eagerpy as ep
 import foolbox as fb
 from foolbox import attacks as fa
@@ -8,12 +11,19 @@ from foolbox.distances import LpDistance
 from foolbox.criteria import Misclassification, TargetedMisclassification
 from foolbox.attacks.base import MinimizationAttack, T, get_criterion, raise_if_kwargs
 
-from cyipopt import minimize_ipopt
+try:
+    from cyipopt import minimize_ipopt
+except Exception as e:
+    minimize_ipopt = None
+    warnings.warn('Could not import cyipopt, only the torch backend of the orthogonal attack is available.')
 
 
 class OrthogonalAttack(MinimizationAttack):
-    def __init__(self, input_attack, params, adv_dirs=[], random_start=False):
+    def __init__(self, input_attack, params, adv_dirs=[], random_start=False, backend=None):
         super(OrthogonalAttack, self).__init__()
+        # backend overrides input_attack: 'ipopt' solves with cyipopt on the CPU, 'torch' stays on the model's device
+        if backend is not None:
+            input_attack = BACKENDS[backend]
         self.input_attack = input_attack(**params)
         self.distance = LpDistance(2)
         self.dirs = adv_dirs
@@ -27,6 +37,16 @@ class OrthogonalAttack(MinimizationAttack):
 
 
 class CarliniWagner(fa.L2CarliniWagnerAttack):
+    """
+    refinement selects how successful solutions are scaled back to the decision boundary: 'bisection', 'grid', a
+    callable with the signature of bisect_boundary or None to keep the solver output. refinement_tol is the
+    resolution of the boundary scale.
+    """
+    def __init__(self, refinement='bisection', refinement_tol=5e-4, **kwargs: Any):
+        super(CarliniWagner, self).__init__(**kwargs)
+        self.refinement = refinement
+        self.refinement_tol = refinement_tol
+
     def run(
             self,
             model: Model,
@@ -68,29 +88,28 @@ class CarliniWagner(fa.L2CarliniWagnerAttack):
                 f"expected {name} to have shape ({N},), got {classes.shape}"
             )
 
-        rows = range(N)
-
         def loss_fun(
-                adv: ep.Tensor, consts: ep.Tensor
+                adv: ep.Tensor, consts: ep.Tensor, i: int
         ) -> Tuple[ep.Tensor, Tuple[ep.Tensor, ep.Tensor]]:
+            # loss of image i of the batch alone, adv has shape (1, ...)
 
             logits = model(adv)
 
             if targeted:
-                c_minimize = fa.carlini_wagner.best_other_classes(logits, classes)
-                c_maximize = classes  # target_classes
-                is_adv_loss = logits[rows, c_minimize] - logits[rows, c_maximize]
+                c_minimize = fa.carlini_wagner.best_other_classes(logits, classes[i:i + 1])
+                c_maximize = classes[i:i + 1]  # target_classes
+                is_adv_loss = logits[range(1), c_minimize] - logits[range(1), c_maximize]
             else:
 
-                is_adv_loss = 1 / (ep.crossentropy(logits, labels)+1e-15)
+                is_adv_loss = 1 / (ep.crossentropy(logits, labels[i:i + 1])+1e-15)
 
-            assert is_adv_loss.shape == (N,)
+            assert is_adv_loss.shape == (1,)
 
             is_adv_loss = is_adv_loss + self.confidence
             is_adv_loss = ep.maximum(0, is_adv_loss)
             is_adv_loss = is_adv_loss * consts
 
-            squared_norms = (adv - x).flatten(1, -1).square().sum(axis=-1)
+            squared_norms = (adv - x[i:i + 1]).flatten(1, -1).square().sum(axis=-1)
 
             loss = is_adv_loss.sum() + squared_norms.sum()
 
@@ -98,24 +117,33 @@ class CarliniWagner(fa.L2CarliniWagnerAttack):
 
         loss_aux_and_grad = ep.value_and_grad_fn(x, loss_fun, has_aux=True)
 
-        def loss_and_grad(var_opt, consts):
-            var_opt = ep.from_numpy(x, var_opt.astype(np.float64)).reshape(x.shape)
-            loss, _, gradient = loss_aux_and_grad(var_opt, consts)
+        def loss_and_grad(var_opt, consts, i):
+            var_opt = ep.from_numpy(x, var_opt.astype(np.float64)).reshape((1,) + x.shape[1:])
+            loss, _, gradient = loss_aux_and_grad(var_opt, consts, i)
             loss_np = loss.numpy().item()
             grad_np = gradient.flatten().numpy()
             return loss_np, grad_np
 
-        x_np = x.flatten().numpy()
+        if minimize_ipopt is None:
+            raise ImportError('cyipopt is required for the ipopt backend, use backend=\'torch\' instead')
 
-        bnds = [(0, 1) for _ in range(len(x_np))]
+        x_np = x.flatten(1, -1).numpy()
+        n_pixels = x_np.shape[1]
 
-        cons = ()
+        bnds = [(0, 1) for _ in range(n_pixels)]
 
-        if len(dirs)>0:
-            for d in dirs:
-                con = {'type': 'eq', 'fun': lambda adv, d, x_np: ((adv-x_np)*d).sum(), 'args': (d, x_np, ),
-                       'jac': lambda adv, d, x_np: d}
+        # every image is solved as its own IPOPT problem (own line search, barrier parameter and termination test),
+        # so the result of an image does not depend on the rest of the batch; only the model evaluations of the
+        # adversarial checks and the boundary refinement are batched
+        image_cons = []
+        for i, d in enumerate(per_image_dirs(dirs, N, n_pixels)):
+            cons = ()
+            jac = orthogonality_jacobian([d], n_pixels)
+            if jac.shape[0] > 0:
+                con = {'type': 'eq', 'fun': lambda adv, jac, x_i: jac @ (adv - x_i), 'args': (jac, x_np[i], ),
+                       'jac': lambda adv, jac, x_i: jac}
                 cons = cons + (con,)
+            image_cons.append(cons)
 
         consts = self.initial_const * np.ones((N,))
         lower_bounds = np.zeros((N,))
@@ -124,7 +152,7 @@ class CarliniWagner(fa.L2CarliniWagnerAttack):
         best_advs = ep.zeros_like(x)
         best_advs_norms = ep.full(x, (N,), ep.inf)
         # the binary search searches for the smallest consts that produce adversarials
-        count = 0
+        count = np.zeros((N,), dtype=int)
         for binary_search_step in range(self.binary_search_steps):
             if (
                     binary_search_step == self.binary_search_steps - 1
@@ -133,52 +161,308 @@ class CarliniWagner(fa.L2CarliniWagnerAttack):
                 # in the last binary search step, repeat the search once
                 consts = np.minimum(upper_bounds, 1e10)
 
-            consts_ = ep.from_numpy(x, consts.astype(np.float64))
+            # images whose search already stopped (as the attack on that image alone would have) are not solved again
+            active = count < 3
+            res_x = np.zeros_like(x_np)
+            for i in np.flatnonzero(active):
+                consts_ = ep.from_numpy(x, consts[i:i + 1].astype(np.float64))
+                init = (x_np[i]+np.random.normal(scale=1, size=x_np[i].shape)).clip(0, 1)
+                res = minimize_ipopt(loss_and_grad, x0=init,
+                                     jac=True, constraints=image_cons[i], args=(consts_, i),  bounds=bnds,
+                                     options={'maxiter': self.steps, 'disp': 0, 'jac_c_constant': 'yes',
+                                               'jac_d_constant': 'yes'})
+                res_x[i] = res.x
+
+            valid_res = np.logical_and(res_x.max(-1) <= 1.001, res_x.min(-1) >= -0.001)
+            valid_res = np.logical_and(valid_res, np.any(res_x != 0, axis=-1))
+            valid_res = np.logical_and(valid_res, active)
+            perturbed = ep.from_numpy(x, res_x.clip(0, 1).astype(np.float64)).reshape(x.shape)
+
+            # tracks whether adv with the current consts was found
+            logits = model(perturbed)
+            found_advs = np.logical_and(valid_res, is_adversarial(perturbed, logits).numpy())
+
+            if found_advs.any():
+                count += found_advs
+                found_advs_ = fb.devutils.atleast_kd(ep.from_numpy(x, found_advs), x.ndim)
+                perturbed = ep.where(found_advs_, self.refine_boundary(model, x, perturbed, labels), perturbed)
+
+                norms = (perturbed - x).flatten(1, -1).norms.l2(axis=-1)
+                closer = norms < best_advs_norms
+                new_best = ep.logical_and(closer, ep.from_numpy(closer, found_advs))
+
+                new_best_ = fb.devutils.atleast_kd(new_best, best_advs.ndim)
+                best_advs = ep.where(new_best_, perturbed, best_advs)
+                best_advs_norms = ep.where(new_best, norms, best_advs_norms)
 
-            init = (x_np+np.random.normal(scale=1, size=x_np.shape)).clip(0, 1)
-            res = minimize_ipopt(loss_and_grad, x0=init,
-                                 jac=True, constraints=cons, args=(consts_),  bounds=bnds,
-                                 options={'maxiter': self.steps, 'disp': 0, 'jac_c_constant': 'yes',
-                                           'jac_d_constant': 'yes'})
+            upper_bounds = np.where(found_advs, consts, upper_bounds)
+            lower_bounds = np.where(found_advs | ~active, lower_bounds, consts)
 
-            perturbed = ep.from_numpy(x, (res.x).astype(np.float64)).reshape(x.shape)
+            consts_exponential_search = consts * 10
+            consts_binary_search = (lower_bounds + upper_bounds) / 2
+            consts = np.where(active, np.where(
+                np.isinf(upper_bounds), consts_exponential_search, consts_binary_search
+            ), consts)
+            if np.all(count >= 3):
+                break
 
+        return restore_type(best_advs)
 
-            valid_res = True
+    def refine_boundary(self, model, x, perturbed, labels):
+        # scale the perturbations back towards the decision boundary, for all images of the batch at once
+        if self.refinement is None:
+            return perturbed
+        refinement = BOUNDARY_REFINEMENTS.get(self.refinement, self.refinement)
+        return refinement(model, x, perturbed, labels, tol=self.refinement_tol)
+
+
+def bisect_boundary(model, x, perturbed, labels, lower=.5, tol=5e-4):
+    """
+    Finds the smallest scale s in [lower, 1] for which x + s * (perturbed - x) is misclassified by bisection, with
+    one batched forward pass per step (ceil(log2((1 - lower) / tol)) + 1 in total). Images that are not adversarial
+    at s = 1 come back unchanged.
+    """
+    N = len(x)
+    pert = perturbed - x
+
+    def is_adv(scales):
+        return model(x + fb.devutils.atleast_kd(scales, x.ndim) * pert).argmax(axis=-1) != labels
+
+    lo = ep.full(x, (N,), lower)
+    hi = ep.ones(x, (N,))
+    # already adversarial at the lower end of the search interval
+    hi = ep.where(is_adv(lo), lo, hi)
+    for _ in range(int(np.ceil(np.log2((1 - lower) / tol)))):
+        mid = (lo + hi) / 2
+        adv = is_adv(mid)
+        hi = ep.where(adv, mid, hi)
+        lo = ep.where(adv, lo, mid)
+    return x + fb.devutils.atleast_kd(hi, x.ndim) * pert
+
+
+def grid_boundary(model, x, perturbed, labels, lower=.5, tol=5e-4):
+    """
+    Reference refinement: evaluates an evenly spaced grid of scales in [lower, 1] with spacing tol for every image
+    and takes the first misclassified one.
+    """
+    n_scales = int(np.ceil((1 - lower) / tol))
+    batchsize = 100
+    refined = []
+    for i in range(len(x)):
+        pert = perturbed[i:i + 1] - x[i:i + 1]
+        scaled_pert = ep.from_numpy(x, np.linspace(lower, 1, n_scales).astype(np.float64)).reshape((-1, 1, 1, 1)) \
+                      * pert.reshape(x.shape[1:])
+        md_in = x[i:i + 1] + scaled_pert
+        correct_classes = np.zeros(n_scales)
+        for batch in range(int(np.ceil(n_scales/batchsize))):
+            correct_classes[batch*batchsize:(batch+1)*batchsize] = \
+                (model(md_in[batch*batchsize:(batch+1)*batchsize]).argmax(axis=1) == labels[i:i + 1]).numpy()
+        idx = min(int(correct_classes.sum()), n_scales - 1)
+        refined.append(x[i:i + 1] + scaled_pert[idx].reshape((1,) + x.shape[1:]))
+    return ep.concatenate(refined, axis=0)
+
+
+BOUNDARY_REFINEMENTS = {
+    'bisection': bisect_boundary,
+    'grid': grid_boundary,
+}
+
+
+def per_image_dirs(dirs, n_images, n_pixels):
+    """
+    Brings the orthogonality directions into a list with one (k_i, n_pixels) array per image. A flat sequence of
+    directions is only accepted for a single image (the unbatched call of run_attack), otherwise dirs must hold one
+    (possibly empty) set of directions per image. An OrthProjector stands for its orthonormal basis.
+    """
+    if isinstance(dirs, OrthProjector):
+        dirs = [dirs]
+    if len(dirs) == 0:
+        return [np.zeros((0, n_pixels)) for _ in range(n_images)]
+    if n_images == 1 and not isinstance(dirs[0], OrthProjector) and np.ndim(dirs[0]) == 1:
+        return [np.asarray(dirs).reshape((-1, n_pixels))]
+    assert len(dirs) == n_images, 'expected one set of directions per image'
+    return [d.basis.detach().cpu().numpy() if isinstance(d, OrthProjector) else np.asarray(d).reshape((-1, n_pixels))
+            for d in dirs]
+
+
+def orthogonality_jacobian(image_dirs, n_pixels):
+    """
+    The constant Jacobian of the orthogonality constraints of a batch, as a sparse block diagonal matrix: the
+    directions of image i only act on its own block of the flattened batch, so IPOPT gets sum_i k_i * n_pixels
+    nonzeros instead of a dense (sum_i k_i, N * n_pixels) matrix.
+    """
+    rows, cols, data = [], [], []
+    row = 0
+    for i, d in enumerate(image_dirs):
+        k = len(d)
+        rows.append(np.repeat(np.arange(row, row + k), n_pixels))
+        cols.append(np.tile(np.arange(i * n_pixels, (i + 1) * n_pixels), k))
+        data.append(np.asarray(d, dtype=np.float64).reshape(-1))
+        row += k
+    shape = (row, len(image_dirs) * n_pixels)
+    return scipy.sparse.coo_array((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+
+
+class OrthProjector:
+    """
+    Orthonormal basis Q of a growing set of directions. Adding a direction is a single (twice repeated, for numerical
+    stability) Gram-Schmidt step against the current basis, which is O(n k) instead of refactorizing all directions.
+    Directions (numerically) in the span of the basis are skipped, see add.
+    """
+    def __init__(self, n_pixels, max_dims, device='cpu', dtype=torch.double, tol=1e-8):
+        self.Q = torch.zeros((max_dims, n_pixels), device=device, dtype=dtype)
+        self.k = 0
+        self.tol = tol
+
+    def __len__(self):
+        return self.k
+
+    @property
+    def basis(self):
+        return self.Q[:self.k]
+
+    def add(self, direction):
+        """
+        Adds a direction to the basis. Returns False (and leaves the basis unchanged) if the part of the direction
+        orthogonal to the basis is below tol relative to its norm, i.e. it already is in the span.
+        """
+        v = direction.reshape(-1).to(self.Q)
+        norm = torch.norm(v)
+        for _ in range(2):
+            v = v - self.basis.T @ (self.basis @ v)
+        residual_norm = torch.norm(v)
+        if not residual_norm > self.tol * norm:
+            warnings.warn('OrthProjector: skipped a direction in the span of the basis')
+            return False
+        self.Q[self.k] = v / residual_norm
+        self.k += 1
+        return True
+
+    def project(self, v):
+        # projects (a batch of) flattened vectors onto the orthogonal complement of the directions
+        return v - (v @ self.basis.T) @ self.basis
+
+
+class ProjectedCarliniWagner(CarliniWagner):
+    """
+    Same objective and binary search as CarliniWagner, but minimized with projected Adam in torch instead of IPOPT.
+    After every step the iterate is projected onto {adv | Q^T (adv - x) = 0} intersected with the [0, 1] box, where Q
+    is an orthonormal basis (QR) of the directions of each image. The intersection is computed with Dykstra's
+    alternating projections (at most projection_steps iterations, until the iterate is orthogonal to the directions
+    up to projection_tol), so nothing leaves the device of the model.
+    """
+    def __init__(self, projection_steps: int = 100, projection_tol: float = 1e-6, **kwargs: Any):
+        super(ProjectedCarliniWagner, self).__init__(**kwargs)
+        self.projection_steps = projection_steps
+        self.projection_tol = projection_tol
 
-            if perturbed.max() > 1.001 or perturbed.min() < -0.001:
-                valid_res = False
-            elif ep.all(perturbed == 0):
-                valid_res = False
+    def run(
+            self,
+            model: Model,
+            inputs: T,
+            criterion: Union[Misclassification, TargetedMisclassification, T],
+            *,
+            early_stop: Optional[float] = None,
+            random_start: Optional[float] = None,
+            dirs: Optional[Any] = [],
+            **kwargs: Any,
+    ) -> T:
+        raise_if_kwargs(kwargs)
+        x, restore_type = ep.astensor_(inputs)
+        criterion_ = get_criterion(criterion)
+        del inputs, criterion, kwargs
+
+        N = len(x)
+
+        labels = criterion_.labels
+        if isinstance(criterion_, Misclassification):
+            targeted = False
+            classes = criterion_.labels
+            change_classes_logits = self.confidence
+        elif isinstance(criterion_, TargetedMisclassification):
+            targeted = True
+            classes = criterion_.target_classes
+            change_classes_logits = -self.confidence
+        else:
+            raise ValueError("unsupported criterion")
+
+        def is_adversarial(perturbed: ep.Tensor, logits: ep.Tensor) -> ep.Tensor:
+            if change_classes_logits != 0:
+                logits += ep.onehot_like(logits, classes, value=change_classes_logits)
+            return criterion_(perturbed, logits)
+
+        if classes.shape != (N,):
+            name = "target_classes" if targeted else "labels"
+            raise ValueError(
+                f"expected {name} to have shape ({N},), got {classes.shape}"
+            )
+
+        rows = range(N)
+        x_ = x.raw
+        classes_ = classes.raw
+        labels_ = labels.raw
+        project = box_subspace_projection(x_, dirs, self.projection_steps, self.projection_tol)
+
+        def loss_fun(adv, consts):
+            logits = model(adv)
+
+            if targeted:
+                other = logits.clone()
+                other[rows, classes_] = -np.inf
+                is_adv_loss = other.max(-1)[0] - logits[rows, classes_]
             else:
-                perturbed = perturbed.clip(0, 1)
+                is_adv_loss = 1 / (torch.nn.functional.cross_entropy(logits, labels_, reduction='none') + 1e-15)
 
-            # tracks whether adv with the current consts was found
-            found_advs = np.full((N,), fill_value=False)
-            if valid_res:
-                logits = model(perturbed)
-
-                found_advs_iter = is_adversarial(perturbed, logits)
-                found_advs = np.logical_or(found_advs, found_advs_iter.numpy())
-
-                if found_advs_iter:
-                    count += 1
-                    pert = perturbed - x
-                    n_scales = 1000
-                    batchsize = 100
-                    scaled_pert = ep.from_numpy(x, np.linspace(.5, 1, n_scales).astype(np.float64)).reshape((-1, 1, 1, 1)) \
-                                  * pert.reshape(x.shape[1:])
-                    md_in = x + scaled_pert
-                    correct_classes = np.zeros(n_scales)
-                    for batch in range(int(n_scales/batchsize)):
-                        correct_classes[batch*batchsize:(batch+1)*batchsize] = \
-                            (model(md_in[batch*batchsize:(batch+1)*batchsize]).argmax(axis=1) == labels).numpy()
-                    idx = int(correct_classes.sum())
-                    perturbed = x + scaled_pert[idx].reshape(x.shape)
-
-                norms = (perturbed - x).flatten().norms.l2(axis=-1)
+            is_adv_loss = (is_adv_loss + self.confidence).clamp(min=0) * consts
+            squared_norms = (adv - x_).flatten(1).square().sum(-1)
+            return is_adv_loss + squared_norms
+
+        consts = self.initial_const * np.ones((N,))
+        lower_bounds = np.zeros((N,))
+        upper_bounds = np.inf * np.ones((N,))
+
+        best_advs = ep.zeros_like(x)
+        best_advs_norms = ep.full(x, (N,), ep.inf)
+        count = np.zeros((N,), dtype=int)
+        for binary_search_step in range(self.binary_search_steps):
+            if (
+                    binary_search_step == self.binary_search_steps - 1
+                    and self.binary_search_steps >= 10
+            ):
+                # in the last binary search step, repeat the search once
+                consts = np.minimum(upper_bounds, 1e10)
+
+            consts_ = torch.as_tensor(consts, dtype=x_.dtype, device=x_.device)
+
+            adv = project((x_ + torch.randn_like(x_)).clamp(0, 1)).requires_grad_(True)
+            optimizer = torch.optim.Adam([adv], lr=self.stepsize)
+            loss_at_previous_check = np.inf
+            for step in range(self.steps):
+                optimizer.zero_grad()
+                loss = loss_fun(adv, consts_).sum()
+                loss.backward()
+                optimizer.step()
+                with torch.no_grad():
+                    adv.copy_(project(adv))
+
+                if self.abort_early and step % (np.ceil(self.steps / 10)) == 0:
+                    # after each tenth of the overall steps, check progress
+                    if not (loss.item() <= 0.9999 * loss_at_previous_check):
+                        break
+                    loss_at_previous_check = loss.item()
+
+            perturbed = ep.astensor(adv.detach())
+            logits = model(perturbed)
+            found_advs = is_adversarial(perturbed, logits).numpy()
+
+            if found_advs.any():
+                count += found_advs
+                found_advs_ = fb.devutils.atleast_kd(ep.from_numpy(x, found_advs), x.ndim)
+                perturbed = ep.where(found_advs_, self.refine_boundary(model, x, perturbed, labels), perturbed)
+
+                norms = (perturbed - x).flatten(1, -1).norms.l2(axis=-1)
                 closer = norms < best_advs_norms
-                new_best = ep.logical_and(closer, found_advs_iter)
+                new_best = ep.logical_and(closer, ep.from_numpy(closer, found_advs))
 
                 new_best_ = fb.devutils.atleast_kd(new_best, best_advs.ndim)
                 best_advs = ep.where(new_best_, perturbed, best_advs)
@@ -192,7 +476,68 @@ class CarliniWagner(fa.L2CarliniWagnerAttack):
             consts = np.where(
                 np.isinf(upper_bounds), consts_exponential_search, consts_binary_search
             )
-            if count == 3:
+            if np.all(count >= 3):
                 break
 
         return restore_type(best_advs)
+
+
+def box_subspace_projection(x, dirs, n_steps=100, tol=1e-6):
+    """
+    Returns a function projecting a batch onto {adv | adv - x orthogonal to dirs} intersected with [0, 1]^n, using
+    Dykstra's algorithm. dirs holds one OrthProjector or (k_i, n_pixels) array of directions per image.
+    The iterations stop once |Q^T (adv - x)| <= tol for all images (or after n_steps). The result is always
+    projected onto the subspace last, so it is orthogonal to the directions; it may leave the box by up to tol,
+    which is warned about if the iterations did not get it closer than that.
+    """
+    N = len(x)
+    n_pixels = x[0].numel()
+    if isinstance(dirs, OrthProjector):
+        dirs = [dirs]
+    elif len(dirs) == 0 or not isinstance(dirs[0], OrthProjector):
+        dirs = per_image_dirs(dirs, N, n_pixels)
+    k = max([len(d) for d in dirs] + [0])
+    # orthonormal bases of the directions, zero padded to a common number of columns
+    Q = torch.zeros((N, n_pixels, k), dtype=x.dtype, device=x.device)
+    for i, d in enumerate(dirs):
+        if isinstance(d, OrthProjector):
+            Q[i, :, :len(d)] = d.basis.T.to(Q)
+        elif len(d) > 0:
+            Q[i, :, :len(d)] = torch.linalg.qr(torch.as_tensor(d.T, dtype=x.dtype, device=x.device))[0]
+    x_flat = x.reshape((N, -1))
+
+    def residual(v):
+        return Q.transpose(1, 2) @ (v - x_flat)[..., None]
+
+    def subspace(v):
+        return v - (Q @ residual(v))[..., 0]
+
+    def project(adv):
+        y = adv.detach().reshape((N, -1))
+        if k == 0:
+            return y.clamp(0, 1).reshape(x.shape)
+        p = torch.zeros_like(y)
+        q = torch.zeros_like(y)
+        for _ in range(n_steps):
+            z = subspace(y + p)
+            p = y + p - z
+            y_ = (z + q).clamp(0, 1)
+            q = z + q - y_
+            y = y_
+            if residual(y).abs().max() <= tol:
+                break
+        # end on the subspace, the box is only ever violated by the remaining residual
+        y = subspace(y)
+        box_violation = torch.maximum(-y, y - 1).max()
+        if box_violation > tol:
+            warnings.warn('box_subspace_projection did not converge in %d steps, the projection is outside of the box '
+                          'by %.2e' % (n_steps, box_violation))
+        return y.reshape(x.shape)
+
+    return project
+
+
+BACKENDS = {
+    'ipopt': CarliniWagner,
+    'torch': ProjectedCarliniWagner,
+}
@@ -10,7 +10,8 @@ from robustness1.datasets import CIFAR
 # own modules
 from utils import load_data, dev
 from attacks import CarliniWagner
-from run_attack import run_attack
+from run_attack import run_batched_attack
+from result_store import DecompositionStore
 from models import model as md
 
 if __name__ == "__main__":
@@ -35,7 +36,8 @@ if __name__ == "__main__":
         'n_adv_dims': 50,
         'early_stop': 3,
         'input_attack': CarliniWagner,
-        'random_start': False
+        'random_start': False,
+        'backend': 'ipopt'  # or 'torch' for the on-device projected solver
     }
 
     # set seeds
@@ -86,32 +88,24 @@ if __name__ == "__main__":
     images = images.to(dev())
     labels = labels.to(dev())
 
-    # initialize data arrays
-    advs = np.zeros((batchsize, params['n_adv_dims'], images[0].shape[0] * images[0].shape[-1]**2))
-    dirs = np.zeros((batchsize, params['n_adv_dims'], images[0].shape[0] * images[0].shape[-1]**2))
-    pert_lengths = np.zeros((batchsize, params['n_adv_dims']))
-    adv_class = np.zeros((batchsize, params['n_adv_dims']))
-
-    # run decomposition over batches
-    for i in range(len(images)):
-        new_advs, new_dirs, new_classes, new_pert_lengths = run_attack(model, images[i].unsqueeze(0), labels[i].unsqueeze(0),
-                                                                       attack_params, **params)
-        advs[i] = new_advs.cpu().detach().numpy()
-        dirs[i] = new_dirs.cpu().detach().numpy()
-        adv_class[i] = new_classes.cpu().detach().numpy()
-        pert_lengths[i] = new_pert_lengths.cpu().detach().numpy()
-
-        data = {
-            'advs': advs,
-            'dirs': dirs,
-            'adv_class': adv_class,
-            'pert_lengths': pert_lengths,
-            'images': images.detach().cpu().numpy(),
-            'labels': labels.detach().cpu().numpy(),
-        }
-
-        if is_natural:
-            save_path = '../data/cifar_natural_' + str(batch_n) + '.npy'
-        else:
-            save_path = '../data/cifar_robust_' + str(batch_n) + '.npy'
-        np.save(save_path, data)
\ No newline at end of file
+    if is_natural:
+        save_path = '../data/cifar_natural_' + str(batch_n)
+    else:
+        save_path = '../data/cifar_robust_' + str(batch_n)
+
+    # every found dimension is committed to the store right away, so a restarted job continues where it stopped
+    store = DecompositionStore(save_path + '_store')
+
+    # run decomposition for the whole batch at once
+    advs, dirs, adv_class, pert_lengths = run_batched_attack(model, images, labels, attack_params, store=store,
+                                                             **params)
+
+    data = {
+        'advs': advs.cpu().detach().numpy(),
+        'dirs': dirs.cpu().detach().numpy(),
+        'adv_class': adv_class.cpu().detach().numpy(),
+        'pert_lengths': pert_lengths.cpu().detach().numpy(),
+        'images': images.detach().cpu().numpy(),
+        'labels': labels.detach().cpu().numpy(),
+    }
+    np.save(save_path + '.npy', data)
\ No newline at end of file
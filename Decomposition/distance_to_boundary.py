@@ -5,7 +5,7 @@ import torch
 import numpy as np
 
 from models import model
-from utils import dev
+from utils import dev, load_result_dict
 
 def get_dist_dec(orig, label, dirs, model, n_samples=1000):
     n_scales = 100
@@ -54,7 +54,7 @@ model_robust.to(dev())
 model_robust.eval()
 
 # load data
-data = np.load(f'../data/natural_{seed}.npy', allow_pickle=True).item()
+data = load_result_dict(f'../data/natural_{seed}.npy')
 advs = data['advs']
 pert_lengths = data['pert_lengths']
 classes = data['adv_class']
@@ -63,7 +63,7 @@ images = data['images']
 labels = data['labels']
 pert_lengths = data['pert_lengths']
 
-data = np.load(f'../data/robust_{seed}.npy', allow_pickle=True).item()
+data = load_result_dict(f'../data/robust_{seed}.npy')
 advs_madry = data['advs']
 pert_lengths_madry = data['pert_lengths']
 classes_madry = data['adv_class']
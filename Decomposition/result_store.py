@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+from utils import save_npz_atomic
+
+
+class DecompositionStore:
+    """
+    Append-only store for decomposition runs. Every found dimension is written to its own small file
+    (<directory>/image_<i>/dim_<d>.npz) as soon as it is found, and a 'done' marker is written once an image has
+    all its dimensions or stopped early. A restarted job reads back the committed dimensions of each image and
+    continues from the last one instead of starting from scratch.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _image_dir(self, image_id):
+        return os.path.join(self.directory, 'image_%05d' % image_id)
+
+    def _dim_file(self, image_id, dim):
+        return os.path.join(self._image_dir(image_id), 'dim_%03d.npz' % dim)
+
+    def write_dim(self, image_id, dim, adv, adv_dir, adv_class, pert_length):
+        os.makedirs(self._image_dir(image_id), exist_ok=True)
+        save_npz_atomic(self._dim_file(image_id, dim), adv=adv, dir=adv_dir, adv_class=adv_class,
+                        pert_length=pert_length)
+
+    def finish(self, image_id):
+        os.makedirs(self._image_dir(image_id), exist_ok=True)
+        open(os.path.join(self._image_dir(image_id), 'done'), 'w').close()
+
+    def is_finished(self, image_id):
+        return os.path.isfile(os.path.join(self._image_dir(image_id), 'done'))
+
+    def load_image(self, image_id):
+        """
+        Returns the committed dimensions of an image as lists (advs, dirs, adv_class, pert_lengths), in the order
+        they were found, up to the first missing one.
+        """
+        advs, dirs, adv_class, pert_lengths = [], [], [], []
+        dim = 0
+        while os.path.isfile(self._dim_file(image_id, dim)):
+            with np.load(self._dim_file(image_id, dim)) as data:
+                advs.append(data['adv'])
+                dirs.append(data['dir'])
+                adv_class.append(data['adv_class'].item())
+                pert_lengths.append(data['pert_length'].item())
+            dim += 1
+        return advs, dirs, adv_class, pert_lengths
+
+    def to_dict(self, image_ids, n_adv_dims, n_pixels):
+        """
+        Collects the stored dimensions into the zero padded advs/dirs/adv_class/pert_lengths arrays of decomp_fun.py.
+        """
+        advs = np.zeros((len(image_ids), n_adv_dims, n_pixels))
+        dirs = np.zeros((len(image_ids), n_adv_dims, n_pixels))
+        adv_class = np.zeros((len(image_ids), n_adv_dims))
+        pert_lengths = np.zeros((len(image_ids), n_adv_dims))
+        for i, image_id in enumerate(image_ids):
+            advs_, dirs_, adv_class_, pert_lengths_ = self.load_image(image_id)
+            n = len(advs_)
+            if n > 0:
+                advs[i, :n] = advs_
+                dirs[i, :n] = dirs_
+                adv_class[i, :n] = adv_class_
+                pert_lengths[i, :n] = pert_lengths_
+        return {
+            'advs': advs,
+            'dirs': dirs,
+            'adv_class': adv_class,
+            'pert_lengths': pert_lengths,
+        }
@@ -1,5 +1,6 @@
+import numpy as np
 import torch
-from attacks import OrthogonalAttack, CarliniWagner
+from attacks import OrthogonalAttack, CarliniWagner, OrthProjector
 from utils import classification, dev
 from tqdm import tqdm
 import foolbox
@@ -14,7 +15,10 @@ def run_attack(model,
               n_adv_dims=3,
               early_stop=3,
               epsilons=[None],
-              verbose=False
+              verbose=False,
+              backend=None,
+              store=None,
+              image_id=0
     ):
     fmodel = foolbox.models.PyTorchModel(model,  # return logits in shape (bs, n_classes)
                                          bounds=(0., 1.),  # num_classes=10,
@@ -30,9 +34,21 @@ def run_attack(model,
     adv_class = torch.zeros(n_adv_dims, device=dev(), dtype=int)
     advs = torch.zeros((n_adv_dims, n_channels * n_pixel), device=dev())
     adv_dirs = torch.zeros((n_adv_dims, n_channels * n_pixel), device=dev())
-    dirs=[]
+    dirs = OrthProjector(n_channels * n_pixel, n_adv_dims, device=dev())
 
     dim = 0
+    # resume from the dimensions committed by a previous run
+    if store is not None:
+        for adv_, dir_, class_, pert_length_ in zip(*store.load_image(image_id)):
+            advs[dim] = torch.as_tensor(adv_, device=dev())
+            adv_dirs[dim] = torch.as_tensor(dir_, device=dev())
+            dirs.add(adv_dirs[dim])
+            adv_class[dim] = class_
+            pert_lengths[dim] = pert_length_
+            dim += 1
+        if store.is_finished(image_id):
+            return advs, adv_dirs, adv_class, pert_lengths
+
     run = 0
     while dim < n_adv_dims:
 
@@ -42,7 +58,8 @@ def run_attack(model,
         attack = OrthogonalAttack(input_attack=input_attack,
                                   params=attack_params,
                                   adv_dirs=dirs,
-                                  random_start=random_start)
+                                  random_start=random_start,
+                                  backend=backend)
         # attack = foolbox.attacks.L2CarliniWagnerAttack(**attack_params)
         _, adv, success = attack(fmodel, image, label, epsilons=epsilons)
         adv = adv[0]
@@ -52,6 +69,8 @@ def run_attack(model,
             count += 1
             if early_stop == count:
                 print('No more adversarials found ----> early stop!')
+                if store is not None:
+                    store.finish(image_id)
                 break
             continue
 
@@ -66,9 +85,125 @@ def run_attack(model,
         adv_dirs[dim] = adv_dir
         adv_class[dim] = class_
         pert_lengths[dim] = pert_length
+        if store is not None:
+            store.write_dim(image_id, dim, a_.detach().cpu().numpy(), adv_dir.detach().cpu().numpy(), int(class_),
+                            pert_length.item())
 
-        dirs = adv_dirs[:dim+1].detach().cpu().numpy()
+        dirs.add(adv_dir)
         dim += 1
 
+    if store is not None:
+        store.finish(image_id)
+    print('Dimensions' + str(dim))
+    return advs, adv_dirs, adv_class, pert_lengths
+
+def run_batched_attack(model,
+                       images,
+                       labels,
+                       attack_params,
+                       random_start=True,
+                       input_attack=CarliniWagner,
+                       n_adv_dims=3,
+                       early_stop=3,
+                       epsilons=[None],
+                       verbose=False,
+                       backend=None,
+                       store=None,
+                       image_ids=None
+    ):
+    """
+    Batched version of run_attack: every run solves the orthogonal attack for all images that still need a
+    dimension at once, each image constrained only by its own directions.
+    Returns advs, adv_dirs, adv_class and pert_lengths with a leading image dimension.
+    If a DecompositionStore is given, every found dimension is committed to it under image_ids[i] (default i) and
+    dimensions already in the store are resumed from instead of being recomputed.
+    """
+    fmodel = foolbox.models.PyTorchModel(model,  # return logits in shape (bs, n_classes)
+                                         bounds=(0., 1.),  # num_classes=10,
+                                         device=dev())
+
+    # initialize variables
+    n_images = len(images)
+    x_orig = images.flatten(1)
+    n_dims = x_orig.shape[-1]
+
+    pert_lengths = torch.zeros((n_images, n_adv_dims), device=dev())
+    adv_class = torch.zeros((n_images, n_adv_dims), device=dev(), dtype=int)
+    advs = torch.zeros((n_images, n_adv_dims, n_dims), device=dev())
+    adv_dirs = torch.zeros((n_images, n_adv_dims, n_dims), device=dev())
+    projectors = [OrthProjector(n_dims, n_adv_dims, device=dev()) for _ in range(n_images)]
+
+    dim = np.zeros(n_images, dtype=int)
+    count = np.zeros(n_images, dtype=int)
+    active = np.ones(n_images, dtype=bool)
+    if image_ids is None:
+        image_ids = list(range(n_images))
+
+    # resume from the dimensions committed by a previous run
+    if store is not None:
+        for i, image_id in enumerate(image_ids):
+            for adv_, dir_, class_, pert_length_ in zip(*store.load_image(image_id)):
+                advs[i, dim[i]] = torch.as_tensor(adv_, device=dev())
+                adv_dirs[i, dim[i]] = torch.as_tensor(dir_, device=dev())
+                projectors[i].add(adv_dirs[i, dim[i]])
+                adv_class[i, dim[i]] = class_
+                pert_lengths[i, dim[i]] = pert_length_
+                dim[i] += 1
+            if store.is_finished(image_id) or dim[i] == n_adv_dims:
+                active[i] = False
+
+    run = 0
+    while active.any():
+
+        if verbose:
+            print('Run %d' % (run + 1))
+        run += 1
+        idx = np.flatnonzero(active)
+        dirs = [projectors[i] for i in idx]
+        attack = OrthogonalAttack(input_attack=input_attack,
+                                  params=attack_params,
+                                  adv_dirs=dirs,
+                                  random_start=random_start,
+                                  backend=backend)
+        idx_ = torch.as_tensor(idx, device=images.device)
+        _, adv, success = attack(fmodel, images[idx_], labels[idx_], epsilons=epsilons)
+        adv = adv[0]
+        success = success.reshape(-1)
+        with torch.no_grad():
+            classes = model(adv).argmax(-1)
+
+        for j, i in enumerate(idx):
+            # check if adversarials were found and stop early if not, an output that the model still classifies
+            # correctly counts as a failed run (its dimension stays empty)
+            if not success[j] or (adv[j] == 0).all() or classes[j] == labels[i]:
+                print('--No attack within bounds found for image %d--' % i)
+                count[i] += 1
+                if early_stop == count[i]:
+                    print('No more adversarials found for image %d ----> early stop!' % i)
+                    active[i] = False
+                    if store is not None:
+                        store.finish(image_ids[i])
+                continue
+
+            count[i] = 0
+
+            a_ = adv[j].flatten()
+            pert_length = torch.norm(a_ - x_orig[i])
+
+            advs[i, dim[i]] = a_
+            adv_dirs[i, dim[i]] = (a_ - x_orig[i]) / pert_length
+            projectors[i].add(adv_dirs[i, dim[i]])
+            adv_class[i, dim[i]] = classes[j]
+            pert_lengths[i, dim[i]] = pert_length
+            if store is not None:
+                store.write_dim(image_ids[i], dim[i], a_.detach().cpu().numpy(),
+                                adv_dirs[i, dim[i]].detach().cpu().numpy(), int(classes[j]), pert_length.item())
+
+            dim[i] += 1
+            if dim[i] == n_adv_dims:
+                active[i] = False
+                if store is not None:
+                    store.finish(image_ids[i])
+
     print('Dimensions' + str(dim))
-    return advs, adv_dirs, adv_class, pert_lengths
\ No newline at end of file
+    return advs, adv_dirs, adv_class, pert_lengths
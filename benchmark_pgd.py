@@ -0,0 +1,53 @@
+"""
+Measures the PGD throughput (adversarial examples per second) of an AttackerModel on the CPU, for different numbers of
+intra-op threads, with and without the channels last memory format. Uses a CIFAR ResNet18 with random weights.
+
+usage:
+    python benchmark_pgd.py [batch_size] [iterations] [n_threads ...]
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+
+from robustness1 import cifar_models
+from robustness1.attacker import AttackerModel
+from robustness1.tools import helpers
+
+# mean and std of robustness1.datasets.CIFAR
+CIFAR_STATS = SimpleNamespace(mean=torch.tensor([0.4914, 0.4822, 0.4465]), std=torch.tensor([0.2023, 0.1994, 0.2010]))
+
+
+def pgd_throughput(model, images, labels, iterations, n_repeats=3):
+    attack_kwargs = {
+        'constraint': '2',
+        'eps': 0.5,
+        'step_size': 0.1,
+        'iterations': iterations,
+        'random_start': True,
+    }
+    model(images, labels, make_adv=True, **attack_kwargs) # warm up
+    start = time.time()
+    for _ in range(n_repeats):
+        model(images, labels, make_adv=True, **attack_kwargs)
+    return n_repeats * len(images) / (time.time() - start)
+
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    all_n_threads = [int(n) for n in sys.argv[3:]] or [1, os.cpu_count()]
+
+    torch.manual_seed(0)
+    images = torch.rand(batch_size, 3, 32, 32)
+    labels = torch.randint(0, 10, (batch_size,))
+    for n_threads in all_n_threads:
+        helpers.set_cpu_threads(n_threads)
+        for channels_last in [False, True]:
+            model = AttackerModel(cifar_models.ResNet18(), CIFAR_STATS).eval()
+            model = helpers.to_device(model, 'cpu', channels_last)
+            throughput = pgd_throughput(model, images, labels, iterations)
+            print(f'threads {n_threads:3d}, channels_last {channels_last!s:5}: {throughput:8.1f} images/s')
@@ -5,7 +5,7 @@ from robustness1.datasets import CIFAR
 import dill
 import sys
 
-from utils import dev, get_dist_dec
+from utils import dev, get_dist_dec_batch, load_result_dict
 
 import tqdm
 
@@ -34,7 +34,7 @@ if __name__ == "__main__":
 
     # load data
     data_path = './data/cifar_natural_diff.npy'
-    data = np.load(data_path, allow_pickle=True).item()
+    data = load_result_dict(data_path)
     pert_lengths = data['pert_lengths']
     dirs = data['dirs']
     images = data['images']
@@ -48,14 +48,13 @@ if __name__ == "__main__":
     all_dists = []
 
     n = n_samples[sample_n]
-    dists = np.zeros((len(images), n))
-    for i, img in enumerate(tqdm.tqdm(images)):
-        dists[i], _, _ = get_dist_dec(img, labels[i], dirs[i, :n_dims], model, min_dist=0.5 * min_dists[i],
-                                      n_samples=n)
+    # all images share the same model batches
+    dists, _, _ = get_dist_dec_batch(images, labels, [dirs[i, :n_dims] for i in range(len(images))], model,
+                                     min_dists=0.5 * min_dists, n_samples=n)
 
-        data = {
-            'dists': dists,
-        }
+    data = {
+        'dists': dists,
+    }
 
-        save_path = './data/sample_convergence_' + str(sample_n) + '.npy'
-        np.save(save_path, data)
\ No newline at end of file
+    save_path = './data/sample_convergence_' + str(sample_n) + '.npy'
+    np.save(save_path, data)
@@ -0,0 +1,8 @@
+import sys
+
+from utils import convert_npy_dict
+
+# converts pickled result dicts (e.g. ./data/cifar_natural_diff.npy) into the memory-mapped format
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(path + ' -> ' + convert_npy_dict(path))
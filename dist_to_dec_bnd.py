@@ -5,7 +5,7 @@ from robustness1.datasets import CIFAR
 import dill
 import sys
 
-from utils import dev, get_dist_dec
+from utils import dev, get_dist_dec_batch, load_result_dict
 
 import tqdm
 
@@ -40,7 +40,7 @@ if __name__ == "__main__":
         data_path = './data/cifar_natural_diff.npy'
     else:
         data_path = './data/cifar_robust_diff.npy'
-    data = np.load(data_path, allow_pickle=True).item()
+    data = load_result_dict(data_path)
     pert_lengths = data['pert_lengths']
     dirs = data['dirs']
     images = data['images']
@@ -56,10 +56,11 @@ if __name__ == "__main__":
     angles= np.zeros((len(images), n_dims, n_samples))
     largest_vecs = np.zeros((len(images), n_dims, dirs.shape[-1]))
     for i, img in enumerate(tqdm.tqdm(images)):
-        for n in np.arange(0, n_dims):
-            dists[i, n], angles[i, n], largest_vecs[i, n] = get_dist_dec(img, labels[i], dirs[i, :n + 1], model,
-                                                                         min_dist=0.5 * min_dists[i],
-                                                                         n_samples=n_samples)
+        # all direction prefixes of the image share the same model batches
+        dists[i], angles[i], largest_vecs[i] = get_dist_dec_batch([img] * n_dims, [labels[i]] * n_dims,
+                                                                  [dirs[i, :n + 1] for n in range(n_dims)], model,
+                                                                  min_dists=0.5 * min_dists[i],
+                                                                  n_samples=n_samples)
 
         data = {
             'dists': dists,
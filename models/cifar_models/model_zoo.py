@@ -50,6 +50,13 @@ class Swish(nn.Module):
     return _Swish.apply(input_tensor)
 
 
+class FunctionalSwish(nn.Module):
+  """Swish from plain tensor operations, which (unlike _Swish) vmap can batch."""
+
+  def forward(self, input_tensor):
+    return input_tensor * torch.sigmoid(input_tensor)
+
+
 class _Block(nn.Module):
   """WideResNet Block."""
 
@@ -30,6 +30,19 @@ class AttackerStep:
         self.eps = eps
         self.step_size = step_size
         self.use_grad = use_grad
+        self._buffers = {}
+
+    def _buffer(self, name, shape, like):
+        '''
+        A preallocated buffer, reused by the in-place steps for as long as
+        the shape, dtype and device do not change.
+        '''
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != like.dtype \
+                or buf.device != like.device:
+            buf = like.new_empty(shape)
+            self._buffers[name] = buf
+        return buf
 
     def project(self, x):
         '''
@@ -65,6 +78,23 @@ class AttackerStep:
         '''
         raise NotImplementedError
 
+    def project_(self, x):
+        '''
+        In-place version of :meth:`project`: overwrites x with its
+        projection and returns it. Subclasses override this to avoid
+        allocating new tensors in every PGD iteration, the default falls back
+        to :meth:`project`.
+        '''
+        return x.copy_(self.project(x))
+
+    def step_(self, x, g):
+        '''
+        In-place version of :meth:`step`: overwrites x with the new input and
+        returns it. Subclasses override this to avoid allocating new tensors
+        in every PGD iteration, the default falls back to :meth:`step`.
+        '''
+        return x.copy_(self.step(x, g))
+
     def to_image(self, x):
         '''
         Given an input (which may be in an alternative parameterization),
@@ -104,6 +134,19 @@ class LinfStep(AttackerStep):
         new_x = x + 2 * (ch.rand_like(x) - 0.5) * self.eps
         return ch.clamp(new_x, 0, 1)
 
+    def project_(self, x):
+        """
+        """
+        diff = ch.sub(x, self.orig_input, out=self._buffer('diff', x.shape, x))
+        diff.clamp_(-self.eps, self.eps)
+        return ch.add(self.orig_input, diff, out=x).clamp_(0, 1)
+
+    def step_(self, x, g):
+        """
+        """
+        sign = ch.sign(g, out=self._buffer('diff', x.shape, x))
+        return x.add_(sign, alpha=self.step_size)
+
 # L2 threat model
 class L2Step(AttackerStep):
     """
@@ -135,6 +178,27 @@ class L2Step(AttackerStep):
         rp_norm = rp.view(rp.shape[0], -1).norm(dim=1).view(-1, *([1]*l))
         return ch.clamp(x + self.eps * rp / (rp_norm + 1e-10), 0, 1)
 
+    def project_(self, x):
+        """
+        """
+        l = len(x.shape) - 1
+        diff = ch.sub(x, self.orig_input, out=self._buffer('diff', x.shape, x))
+        norm = self._buffer('norm', (x.shape[0],), x)
+        ch.linalg.vector_norm(diff.view(x.shape[0], -1), dim=1, out=norm)
+        # same scaling as renorm: eps / (norm + 1e-7) where norm > eps
+        norm.add_(1e-7).reciprocal_().mul_(self.eps).clamp_(max=1)
+        diff.mul_(norm.view(-1, *([1]*l)))
+        return ch.add(self.orig_input, diff, out=x).clamp_(0, 1)
+
+    def step_(self, x, g):
+        """
+        """
+        l = len(x.shape) - 1
+        g_norm = self._buffer('norm', (x.shape[0],), x)
+        ch.linalg.vector_norm(g.view(g.shape[0], -1), dim=1, out=g_norm)
+        g_norm.add_(1e-10)
+        return x.addcdiv_(g, g_norm.view(-1, *([1]*l)), value=self.step_size)
+
 # Unconstrained threat model
 class UnconstrainedStep(AttackerStep):
     """
@@ -156,6 +220,16 @@ class UnconstrainedStep(AttackerStep):
         new_x = x + (ch.rand_like(x) - 0.5).renorm(p=2, dim=0, maxnorm=step_size)
         return ch.clamp(new_x, 0, 1)
 
+    def project_(self, x):
+        """
+        """
+        return x.clamp_(0, 1)
+
+    def step_(self, x, g):
+        """
+        """
+        return x.add_(g, alpha=self.step_size)
+
 class FourierStep(AttackerStep):
     """
     Step under the Fourier (decorrelated) parameterization of an image.
@@ -68,12 +68,14 @@ class Attacker(ch.nn.Module):
         super(Attacker, self).__init__()
         self.normalize = helpers.InputNormalize(dataset.mean, dataset.std)
         self.model = model
+        self.queries = None
 
     def forward(self, x, target, *_, constraint, eps, step_size, iterations,
                 random_start=False, random_restarts=False, do_tqdm=False,
                 targeted=False, custom_loss=None, should_normalize=True,
                 orig_input=None, use_best=True, return_image=True,
-                est_grad=None, mixed_precision=False):
+                est_grad=None, mixed_precision=False, restart_batch_size=None,
+                early_stop=False, in_place=False):
         """
         Implementation of forward (finds adversarial examples). Note that
         this does **not** perform inference and should not be called
@@ -120,8 +122,30 @@ class Attacker(ch.nn.Module):
                 :math:`\\nabla_x f(x) \\approx \\sum_{i=0}^N f(x + R\\cdot
                 \\vec{\\delta_i})\\cdot \\vec{\\delta_i}`, where
                 :math:`\delta_i` are randomly sampled from the unit ball.
+                Optionally followed by :samp:`batch_size` and
+                :samp:`orthogonal` to query in blocks of at most
+                :samp:`batch_size` inputs and with orthonormal directions
+                (see :meth:`robustness.tools.helpers.calc_est_grad`). The
+                number of queries made for each input (over all iterations
+                and restarts) is kept in :samp:`self.queries`.
             mixed_precision (bool) : if True, use mixed-precision calculations
                 to compute the adversarial examples / do the inference.
+            restart_batch_size (int|None) : if not None (and random_restarts),
+                run all restarts together as one PGD batch of the inputs tiled
+                :samp:`random_restarts` times, in chunks of at most this many
+                inputs, and return the highest (lowest if targeted) loss
+                example per input.
+            early_stop (bool) : if True, stop attacking an input as soon as
+                it is misclassified (classified as :samp:`target` if
+                targeted) and return that iterate for it. Only the remaining
+                inputs are attacked further, so later steps get cheaper as
+                the attack succeeds. Meant for evaluation, where only the
+                success of the attack matters.
+            in_place (bool) : if True, update the PGD iterate, the best
+                example and the best loss in place in fixed buffers (see
+                :meth:`AttackerStep.step_` and :meth:`AttackerStep.project_`)
+                instead of allocating new tensors in every iteration. Ignored
+                if :samp:`early_stop` is set.
         Returns:
             An adversarial example for x (i.e. within a feasible set
             determined by `eps` and `constraint`, but classified as:
@@ -129,6 +153,10 @@ class Attacker(ch.nn.Module):
             * `target` (if `targeted == True`)
             *  not `target` (if `targeted == False`)
 
+            With :samp:`est_grad`, :samp:`self.queries` is set to a (B,)
+            tensor with the number of gradient estimation queries made for
+            each input (None otherwise).
+
         .. [#f1] This means that we actually draw :math:`N/2` random vectors
             from the unit ball, and then use :math:`\delta_{N/2+i} =
             -\delta_{i}`.
@@ -136,7 +164,7 @@ class Attacker(ch.nn.Module):
         # Can provide a different input to make the feasible set around
         # instead of the initial point
         if orig_input is None: orig_input = x.detach()
-        orig_input = orig_input.cuda()
+        orig_input = orig_input.to(x.device)
 
         # Multiplier for gradient ascent [untargeted] or descent [targeted]
         m = -1 if targeted else 1
@@ -145,6 +173,13 @@ class Attacker(ch.nn.Module):
         criterion = ch.nn.CrossEntropyLoss(reduction='none')
         step_class = STEPS[constraint] if isinstance(constraint, str) else constraint
         step = step_class(eps=eps, orig_input=orig_input, step_size=step_size) 
+        make_step = lambda orig: step_class(eps=eps, orig_input=orig, step_size=step_size)
+
+        # Gradient estimation queries per input of the batch
+        queries = None
+        if est_grad is not None:
+            queries = ch.zeros(x.shape[0], dtype=ch.long, device=x.device)
+        all_rows = ch.arange(x.shape[0], device=x.device)
 
         def calc_loss(inp, target):
             '''
@@ -159,8 +194,152 @@ class Attacker(ch.nn.Module):
 
             return criterion(output, target), output
 
-        # Main function for making adversarial examples
-        def get_adv_examples(x):
+        def get_grad(x, loss, target, step, rows):
+            '''
+            Gradient of the (mean) loss with respect to x, or None if the
+            step does not use gradients. rows are the indices of the inputs
+            of x in the batch, for counting the queries
+            '''
+            if not step.use_grad:
+                return None
+            if (est_grad is None) and mixed_precision:
+                with amp.scale_loss(loss, []) as sl:
+                    sl.backward()
+                grad = x.grad.detach()
+                x.grad.zero_()
+            elif (est_grad is None):
+                grad, = ch.autograd.grad(m * loss, [x])
+            else:
+                f = lambda _x, _y: m * calc_loss(step.to_image(_x), _y)[0]
+                rows_queries = ch.zeros(x.shape[0], dtype=ch.long, device=x.device)
+                grad = helpers.calc_est_grad(f, x, target, *est_grad, queries=rows_queries)
+                queries.index_add_(0, rows, rows_queries)
+            return grad
+
+        # Early stopping version of get_adv_examples: inputs that are
+        # adversarial are frozen (written to the output) and removed from the
+        # batch that is attacked
+        def get_adv_examples_early_stop(x, target, step, rows):
+            if random_start:
+                x = step.random_perturb(x)
+            x = x.clone().detach()
+
+            best_x = x.clone()
+            best_loss = None
+            active = ch.arange(x.shape[0], device=x.device)
+            # step of the active inputs, rebuilt whenever the batch shrinks
+            active_step = step
+
+            iterator = range(iterations + 1)
+            if do_tqdm: iterator = tqdm(iterator)
+
+            # PGD iterates, the last pass only evaluates
+            for it in iterator:
+                x_active = x[active].requires_grad_(True)
+                image = active_step.to_image(x_active)
+                losses, out = calc_loss(image, target[active])
+                assert losses.shape[0] == x_active.shape[0], \
+                        'Shape of losses must match input!'
+
+                with ch.no_grad():
+                    if best_loss is None:
+                        best_loss = losses.new_full((x.shape[0],), -m * float('inf'))
+                    if out is None: # custom loss
+                        out = self.model(self.normalize(image) if should_normalize else image)
+                    pred = out.argmax(dim=1)
+                    done = (pred == target[active]) if targeted else (pred != target[active])
+                    if use_best:
+                        replace = m * losses > m * best_loss[active]
+                        best_x[active[replace]] = x_active[replace].detach()
+                        best_loss[active[replace]] = losses[replace].detach()
+                    best_x[active[done]] = x_active[done].detach()
+                    best_loss[active[done]] = losses[done].detach()
+                keep = ~done
+                if it == iterations or not keep.any():
+                    active = active[keep]
+                    break
+
+                # normalized by the full batch size, so that every input gets
+                # the same gradient as in get_adv_examples
+                loss = losses[keep].sum() / x.shape[0]
+                grad = get_grad(x_active, loss, target[active], active_step, rows[active])
+
+                with ch.no_grad():
+                    if not keep.all():
+                        active = active[keep]
+                        active_step = make_step(step.orig_input[active])
+                        x_active = x_active[keep]
+                        grad = None if grad is None else grad[keep]
+                    x_new = active_step.step(x_active, grad)
+                    x[active] = active_step.project(x_new)
+                    if do_tqdm: iterator.set_description("Current loss: {l}, active: {a}".format(l=loss, a=len(active)))
+
+            if not use_best:
+                best_x[active] = x[active]
+            ret = step.to_image(best_x) if return_image else best_x
+            return ret, (best_loss if use_best else None)
+
+        # In-place version of get_adv_examples: the iterate, the best input
+        # and the best loss live in buffers allocated once per attack
+        def get_adv_examples_in_place(x, target, step, rows):
+            if random_start:
+                x = step.random_perturb(x)
+            x = x.clone().detach()
+            extender = [1] * (len(x.shape) - 1)
+
+            best_x = x.clone() if use_best else None
+            best_loss, replace = None, None
+
+            # Updates best_loss and best_x where the loss is higher (lower if
+            # targeted) without allocating (after the first call, which
+            # allocates best_loss in the dtype of the losses)
+            def replace_best_(losses):
+                nonlocal best_loss, replace
+                if best_loss is None:
+                    best_loss = losses.new_full((x.shape[0],), -m * float('inf'))
+                    replace = ch.empty(x.shape[0], dtype=ch.bool, device=x.device)
+                (ch.gt if m == 1 else ch.lt)(losses, best_loss, out=replace)
+                ch.where(replace.view(-1, *extender), x, best_x, out=best_x)
+                ch.where(replace, losses, best_loss, out=best_loss)
+
+            iterator = range(iterations)
+            if do_tqdm: iterator = tqdm(iterator)
+
+            # PGD iterates
+            for _ in iterator:
+                x.requires_grad_(True)
+                losses, out = calc_loss(step.to_image(x), target)
+                assert losses.shape[0] == x.shape[0], \
+                        'Shape of losses must match input!'
+
+                loss = ch.mean(losses)
+                grad = get_grad(x, loss, target, step, rows)
+                x.requires_grad_(False)
+
+                with ch.no_grad():
+                    if use_best: replace_best_(losses.detach())
+
+                    step.step_(x, grad)
+                    step.project_(x)
+                    if do_tqdm: iterator.set_description("Current loss: {l}".format(l=loss))
+
+            if not use_best:
+                return (step.to_image(x) if return_image else x), None
+
+            with ch.no_grad():
+                losses, _ = calc_loss(step.to_image(x), target)
+                replace_best_(losses)
+            return (step.to_image(best_x) if return_image else best_x), best_loss
+
+        # Main function for making adversarial examples, returns them together
+        # with their losses (None if not use_best). rows are the indices of
+        # the inputs of x in the batch
+        def get_adv_examples(x, target, step, rows):
+            if early_stop:
+                return get_adv_examples_early_stop(x, target, step, rows)
+            if in_place:
+                return get_adv_examples_in_place(x, target, step, rows)
+
             # Random start (to escape certain types of gradient masking)
             if random_start:
                 x = step.random_perturb(x)
@@ -193,20 +372,7 @@ class Attacker(ch.nn.Module):
                         'Shape of losses must match input!'
 
                 loss = ch.mean(losses)
-
-                if step.use_grad:
-                    if (est_grad is None) and mixed_precision:
-                        with amp.scale_loss(loss, []) as sl:
-                            sl.backward()
-                        grad = x.grad.detach()
-                        x.grad.zero_()
-                    elif (est_grad is None):
-                        grad, = ch.autograd.grad(m * loss, [x])
-                    else:
-                        f = lambda _x, _y: m * calc_loss(step.to_image(_x), _y)[0]
-                        grad = helpers.calc_est_grad(f, x, target, *est_grad)
-                else:
-                    grad = None
+                grad = get_grad(x, loss, target, step, rows)
 
                 with ch.no_grad():
                     args = [losses, best_loss, x, best_x]
@@ -219,21 +385,45 @@ class Attacker(ch.nn.Module):
             # Save computation (don't compute last loss) if not use_best
             if not use_best: 
                 ret = x.clone().detach()
-                return step.to_image(ret) if return_image else ret
+                return (step.to_image(ret) if return_image else ret), None
 
             losses, _ = calc_loss(step.to_image(x), target)
             args = [losses, best_loss, x, best_x]
             best_loss, best_x = replace_best(*args)
-            return step.to_image(best_x) if return_image else best_x
+            return (step.to_image(best_x) if return_image else best_x), best_loss
+
+        # Batched random restarts: attack the inputs tiled random_restarts
+        # times (in chunks) and gather the worst-case example for each input
+        if random_restarts and restart_batch_size:
+            B = x.shape[0]
+            extender = [1] * (len(x.shape) - 1)
+            tiled_x = x.detach().repeat(random_restarts, *extender)
+            tiled_orig = orig_input.repeat(random_restarts, *extender)
+            tiled_target = target.repeat(random_restarts, *([1] * (len(target.shape) - 1)))
+            tiled_rows = all_rows.repeat(random_restarts)
+            advs, losses = [], []
+            for start in range(0, tiled_x.shape[0], restart_batch_size):
+                chunk = slice(start, start + restart_batch_size)
+                adv, loss = get_adv_examples(tiled_x[chunk], tiled_target[chunk],
+                                             make_step(tiled_orig[chunk]), tiled_rows[chunk])
+                if loss is None:
+                    with ch.no_grad():
+                        image = adv if return_image else step.to_image(adv)
+                        loss, _ = calc_loss(image, tiled_target[chunk])
+                advs.append(adv.detach())
+                losses.append(loss.detach())
+            advs, losses = ch.cat(advs), ch.cat(losses)
+            best_restart = ch.argmax(m * losses.view(random_restarts, B), dim=0)
+            adv_ret = advs[best_restart * B + ch.arange(B, device=advs.device)]
 
         # Random restarts: repeat the attack and find the worst-case
         # example for each input in the batch
-        if random_restarts:
+        elif random_restarts:
             to_ret = None
 
             orig_cpy = x.clone().detach()
             for _ in range(random_restarts):
-                adv = get_adv_examples(orig_cpy)
+                adv, _ = get_adv_examples(orig_cpy, target, step, all_rows)
 
                 if to_ret is None:
                     to_ret = adv.detach()
@@ -246,8 +436,9 @@ class Attacker(ch.nn.Module):
 
             adv_ret = to_ret
         else:
-            adv_ret = get_adv_examples(x)
+            adv_ret, _ = get_adv_examples(x, target, step, all_rows)
 
+        self.queries = queries
         return adv_ret
 
 class AttackerModel(ch.nn.Module):
@@ -95,7 +95,10 @@ PGD_ARGS = [
     ['attack-lr', str, 'step size for PGD', REQ],
     ['use-best', [0, 1], 'if 1 (0) use best (final) PGD step as example', 1],
     ['random-restarts', int, 'number of random PGD restarts for eval', 0],
+    ['restart-batch-size', int, 'if set, run the restarts batched in chunks of this many inputs', None],
     ['random-start', [0, 1], 'start with random noise instead of pgd step', 0],
+    ['early-stop', [0, 1], 'if 1, stop attacking inputs once misclassified (eval only)', 0],
+    ['in-place', [0, 1], 'if 1, update the PGD iterate in place in preallocated buffers', 0],
     ['custom-eps-multiplier', str, 'eps mult. sched (same format as LR)', None]
 ]
 """
@@ -116,6 +119,9 @@ MODEL_LOADER_ARGS = [
     ['resume-optimizer', [0, 1], 'whether to also resume optimizers', 0],
     ['data-aug', [0, 1], 'whether to use data augmentation', 1],
     ['mixed-precision', [0, 1], 'whether to use MP training (faster)', 0],
+    ['device', str, 'device to run on (cuda if available, otherwise cpu)', None],
+    ['cpu-threads', int, 'number of intra-op threads on the cpu (all cores)', None],
+    ['channels-last', [0, 1], 'whether to use the channels last memory format', 0],
 ]
 """
 Arguments essential for constructing the model and dataloaders that will be fed
@@ -51,7 +51,8 @@ class DummyModel(nn.Module):
         return self.model(x)
 
 def make_and_restore_model(*_, arch, dataset, resume_path=None,
-         parallel=False, pytorch_pretrained=False, add_custom_forward=False):
+         parallel=False, pytorch_pretrained=False, add_custom_forward=False,
+         device=None, channels_last=False):
     """
     Makes a model and (optionally) restores it from a checkpoint.
 
@@ -75,11 +76,17 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
             not be passed to forward(). (Useful if you just want to train a
             model and don't care about these arguments, and are passing in an
             arch that you don't want to edit forward() for, e.g.  a pretrained model)
+        device (str|None): device to put the model on (and to load the
+            checkpoint to), see :meth:`robustness.tools.helpers.get_device`
+            (defaults to CUDA if available and the CPU otherwise)
+        channels_last (bool): if True, use the channels last memory format
+            (usually faster on the CPU)
     Returns: 
         A tuple consisting of the model (possibly loaded with checkpoint), and the checkpoint itself
     """
     if (not isinstance(arch, str)) and add_custom_forward:
         arch = DummyModel(arch)
+    device = helpers.get_device(device)
 
     classifier_model = dataset.get_model(arch, pytorch_pretrained) if \
                             isinstance(arch, str) else arch
@@ -90,7 +97,7 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
     checkpoint = None
     if resume_path and os.path.isfile(resume_path):
         print("=> loading checkpoint '{}'".format(resume_path))
-        checkpoint = ch.load(resume_path, pickle_module=dill)
+        checkpoint = ch.load(resume_path, pickle_module=dill, map_location=device)
         
         # Makes us able to load models saved with legacy versions
         state_dict_path = 'model'
@@ -105,9 +112,9 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
         error_msg = "=> no checkpoint found at '{}'".format(resume_path)
         raise ValueError(error_msg)
 
+    model = helpers.to_device(model, device, channels_last)
     if parallel:
-        model = ch.nn.DataParallel(model)
-    model = model.cuda()
+        model = helpers.data_parallel(model, device)
 
     return model, checkpoint
 
@@ -17,23 +17,120 @@ def has_attr(obj, k):
     except AttributeError as e:
         return False
 
-def calc_est_grad(func, x, y, rad, num_samples):
-    B, *_ = x.shape
+def get_device(device=None):
+    """
+    Returns the device to run on: :samp:`device` if given (e.g. 'cpu' or
+    'cuda:1'), otherwise CUDA if it is available and the CPU if not.
+    """
+    if device is not None:
+        return ch.device(device)
+    return ch.device('cuda' if ch.cuda.is_available() else 'cpu')
+
+def model_device(model):
+    """The device of the (first) parameter of a model"""
+    return next(model.parameters()).device
+
+def to_device(model, device=None, channels_last=False):
+    """
+    Moves a model to a device (see :meth:`get_device`), optionally in the
+    channels last memory format, in which convolutions are usually faster
+    on the CPU (inputs do not have to be converted).
+    """
+    model = model.to(get_device(device))
+    if channels_last:
+        model = model.to(memory_format=ch.channels_last)
+    return model
+
+class SingleDeviceWrapper(ch.nn.Module):
+    """
+    Stand-in for DataParallel on devices other than CUDA: calls the wrapped
+    model directly, but keeps it under ``.module`` (and its state dict keys
+    prefixed with ``module.``) just like DataParallel.
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+def data_parallel(model, device, device_ids=None):
+    """
+    Moves a model to a device and wraps it for data parallel training or
+    evaluation: in DataParallel over :samp:`device_ids` (all GPUs by default,
+    only the given one if the device has an index) on CUDA, in a
+    :class:`SingleDeviceWrapper` otherwise.
+    """
+    device = ch.device(device)
+    model = model.to(device)
+    if device.type != 'cuda':
+        return SingleDeviceWrapper(model)
+    if device_ids is None and device.index is not None:
+        device_ids = [device.index]
+    return ch.nn.DataParallel(model, device_ids=device_ids)
+
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    Sets the number of intra-op threads used by CPU operators (all cores by
+    default) and optionally the number of inter-op threads (which can only be
+    set once, before any parallel work was started).
+    """
+    ch.set_num_threads(num_threads or os.cpu_count())
+    if num_interop_threads is not None:
+        ch.set_num_interop_threads(num_interop_threads)
+
+def calc_est_grad(func, x, y, rad, num_samples, batch_size=None,
+                  orthogonal=False, queries=None):
+    """
+    Estimates the gradient of :samp:`func` (one loss per input) at x from
+    antithetic pairs of queries :math:`x \\pm R\\cdot\\vec{\\delta_i}` on the
+    sphere of radius :samp:`rad`.
+
+    The queries are made in blocks of at most :samp:`batch_size` inputs per
+    call of :samp:`func` and the estimate is accumulated over the blocks, so
+    memory does not grow with :samp:`num_samples`.
+
+    Args:
+        func (function) : takes :samp:`(inputs, labels)` and returns a loss
+            per input
+        num_samples (int) : number of queries per input (rounded down to an
+            even number)
+        batch_size (int|None) : maximal number of inputs per call of
+            :samp:`func` (at least one pair per input), all queries at once
+            if None
+        orthogonal (bool) : if True, the directions of an input within a
+            block are orthonormal instead of independent, which lowers the
+            variance of the estimate
+        queries (ch.tensor|None) : optional (B,) tensor to which the number of
+            queries made for each input is added in place
+    """
+    B, *shape = x.shape
     Q = num_samples//2
     N = len(x.shape) - 1
+    D = x[0].numel()
+    extender = [1]*N
+    y_shape = [1] * (len(y.shape) - 1)
+    # antithetic pairs per input in a block
+    block = Q if batch_size is None else max(1, batch_size // (2*B))
+    if orthogonal:
+        block = min(block, D)
     with ch.no_grad():
-        # Q * B * C * H * W
-        extender = [1]*N
-        queries = x.repeat(Q, *extender)
-        noise = ch.randn_like(queries)
-        norm = noise.view(B*Q, -1).norm(dim=-1).view(B*Q, *extender)
-        noise = noise / norm
-        noise = ch.cat([-noise, noise])
-        queries = ch.cat([queries, queries])
-        y_shape = [1] * (len(y.shape) - 1)
-        l = func(queries + rad * noise, y.repeat(2*Q, *y_shape)).view(-1, *extender) 
-        grad = (l.view(2*Q, B, *extender) * noise.view(2*Q, B, *noise.shape[1:])).mean(dim=0)
-    return grad
+        grad = ch.zeros_like(x)
+        for start in range(0, Q, block):
+            q = min(block, Q - start)
+            # q * B * C * H * W
+            if orthogonal:
+                noise = ch.randn(B, D, q, device=x.device, dtype=x.dtype)
+                noise = ch.linalg.qr(noise)[0].permute(2, 0, 1).reshape(q, B, *shape)
+            else:
+                noise = ch.randn(q, B, *shape, device=x.device, dtype=x.dtype)
+                noise /= noise.view(q*B, -1).norm(dim=-1).view(q, B, *extender)
+            noise = ch.cat([-noise, noise])
+            l = func((x + rad * noise).view(2*q*B, *shape), y.repeat(2*q, *y_shape))
+            grad += (l.view(2*q, B, *extender) * noise).sum(dim=0)
+    if queries is not None:
+        queries += 2*Q
+    return grad / (2*Q)
 
 def ckpt_at_epoch(num):
     return '%s_%s' % (num, constants.CKPT_NAME)
@@ -23,6 +23,15 @@ try:
 except Exception as e:
     warnings.warn('Could not import amp.')
 
+def _get_device(args, model):
+    """
+    The device to train or evaluate on: :samp:`args.device` if given,
+    otherwise the device the model is on.
+    """
+    if has_attr(args, 'device'):
+        return helpers.get_device(args.device)
+    return helpers.model_device(model)
+
 def check_required_args(args, eval_only=False):
     """
     Check that the required training arguments are present.
@@ -83,7 +92,7 @@ def make_optimizer_and_schedule(args, model, checkpoint, params):
                                 weight_decay=args.weight_decay)
 
     if args.mixed_precision:
-        model.to('cuda')
+        model.to(_get_device(args, model))
         model, optimizer = amp.initialize(model, optimizer, 'O1')
 
     # Make schedule
@@ -148,7 +157,7 @@ def eval_model(args, model, loader, store):
     writer = store.tensorboard if store else None
 
     assert not hasattr(model, "module"), "model is already in DataParallel."
-    model = ch.nn.DataParallel(model)
+    model = helpers.data_parallel(model, _get_device(args, model))
 
     prec1, nat_loss = _model_loop(args, 'val', loader, 
                                         model, None, 0, False, writer)
@@ -295,7 +304,8 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
 
     # Put the model into parallel mode
     assert not hasattr(model, "module"), "model is already in DataParallel."
-    model = ch.nn.DataParallel(model, device_ids=dp_device_ids).cuda()
+    model = helpers.data_parallel(model, _get_device(args, model),
+                                  device_ids=dp_device_ids)
 
     best_prec1, start_epoch = (0, 0)
     if checkpoint:
@@ -412,6 +422,7 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
 
     # switch to train/eval mode depending
     model = model.train() if is_train else model.eval()
+    device = helpers.model_device(model)
 
     # If adv training (or evaling), set eps and random_restarts appropriately
     if adv:
@@ -437,13 +448,19 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
             'random_start': args.random_start,
             'custom_loss': adv_criterion,
             'random_restarts': random_restarts,
-            'use_best': bool(args.use_best)
+            'use_best': bool(args.use_best),
+            'restart_batch_size': args.restart_batch_size if \
+                    has_attr(args, 'restart_batch_size') else None,
+            'early_stop': (not is_train) and has_attr(args, 'early_stop') \
+                    and bool(args.early_stop),
+            'in_place': has_attr(args, 'in_place') and bool(args.in_place)
         }
 
     iterator = tqdm(enumerate(loader), total=len(loader))
     for i, (inp, target) in iterator:
        # measure data loading time
-        target = target.cuda(non_blocking=True)
+        inp = inp.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
         output, final_inp = model(inp, target=target, make_adv=adv,
                                   **attack_kwargs)
         loss = train_criterion(output, target)
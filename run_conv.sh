@@ -1,3 +1,4 @@
+# to run the whole sweep on one machine with a single model load: python sweep_runner.py convergence [n_workers]
 for j in {0..19} 
 do
     arg1=$j sbatch --job-name=conv_$j conv.sh        
@@ -0,0 +1,141 @@
+"""
+Runs the boundary distance sweeps of dist_to_dec_bnd.py and convergence_dists.py (run_conv.sh) on a single machine.
+The model and the data are loaded once and shared with a pool of worker processes. Every work item
+(image, n_samples, n_dims) writes its own result file, which makes the result directory a persistent work queue: a
+restarted sweep only runs the items without a result. The items of an image are run together by one worker, with one
+get_dist_dec_batch call (shared model batches for all n_dims) per n_samples.
+
+usage:
+    python sweep_runner.py convergence [n_workers]
+    python sweep_runner.py dists is_natural [n_workers]
+"""
+
+import os
+import sys
+
+import numpy as np
+import torch
+import dill
+
+from models import model as md
+from robustness1.datasets import CIFAR
+from utils import dev, get_dist_dec_batch, load_result_dict, run_pool
+
+model = None
+data = None
+
+
+def load_model(resume_path):
+    ds = CIFAR('./data/cifar-10-batches-py')
+    classifier_model = ds.get_model('resnet50', False)
+    model = md.CifarPretrained(classifier_model, ds)
+
+    checkpoint = torch.load(resume_path, pickle_module=dill, map_location=torch.device(dev()))
+
+    state_dict_path = 'model'
+    if not ('model' in checkpoint):
+        state_dict_path = 'state_dict'
+    sd = checkpoint[state_dict_path]
+    sd = {k[len('module.'):]: v for k, v in sd.items()}
+    model.load_state_dict(sd)
+    model.to(dev())
+    model.double()
+    model.eval()
+    return model
+
+
+def item_filename(result_dir, item):
+    return os.path.join(result_dir, 'item_%05d_%03d_%03d.npz' % item)
+
+
+def group_items(items):
+    """
+    Groups the work items by image and, within an image, by n_samples.
+    """
+    groups = {}
+    for item in items:
+        image_idx, n_samples, n_dims = item
+        groups.setdefault(image_idx, {}).setdefault(n_samples, []).append(item)
+    return list(groups.values())
+
+
+def run_group(args):
+    result_dir, group = args
+    for n_samples, items in group.items():
+        image_idx = items[0][0]
+        image = data['images'][image_idx]
+        # seed per (image, n_samples), so results do not depend on the scheduling
+        seed = hash((image_idx, n_samples)) % 2**32
+        dists, angles, largest_vecs = get_dist_dec_batch(
+            [image] * len(items), [data['labels'][image_idx]] * len(items),
+            [data['dirs'][image_idx, :n_dims] for _, _, n_dims in items], model,
+            min_dists=[0.5 * data['pert_lengths'][image_idx, 0]] * len(items), n_samples=n_samples,
+            seed=seed)
+        for item, dists_, angles_, largest_vec in zip(items, dists, angles, largest_vecs):
+            filename = item_filename(result_dir, item)
+            np.savez(filename + '.tmp.npz', dists=dists_, angles=angles_, largest_vec=largest_vec)
+            os.replace(filename + '.tmp.npz', filename)
+    return group
+
+
+def run_sweep(items, result_dir, n_workers):
+    os.makedirs(result_dir, exist_ok=True)
+    todo = [item for item in items if not os.path.isfile(item_filename(result_dir, item))]
+    print('%d of %d items left' % (len(todo), len(items)))
+    args = [(result_dir, group) for group in group_items(todo)]
+    for _ in run_pool(run_group, args, n_workers, shared_models=[model]):
+        pass
+
+
+def load_item(result_dir, item):
+    with np.load(item_filename(result_dir, item)) as result:
+        return result['dists'], result['angles'], result['largest_vec']
+
+
+if __name__ == "__main__":
+    sweep = sys.argv[1]
+    if sweep == 'convergence':
+        is_natural = 1
+        n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    else:
+        is_natural = int(sys.argv[2])
+        n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+    if is_natural:
+        model = load_model('./models/cifar_models/nat_diff.pt')
+        data = load_result_dict('./data/cifar_natural_diff.npy')
+        name = 'natural'
+    else:
+        model = load_model('./models/cifar_models/rob_diff.pt')
+        data = load_result_dict('./data/cifar_robust_diff.npy')
+        name = 'robust'
+    n_images = len(data['images'])
+
+    if sweep == 'convergence':
+        n_samples = [int(x) for x in np.linspace(5, 100, 20)]
+        n_dims = 50
+        items = [(i, n, n_dims) for n in n_samples for i in range(n_images)]
+        result_dir = './data/sample_convergence_sweep'
+        run_sweep(items, result_dir, n_workers)
+
+        for sample_n, n in enumerate(n_samples):
+            dists = np.stack([load_item(result_dir, (i, n, n_dims))[0] for i in range(n_images)])
+            np.save('./data/sample_convergence_' + str(sample_n) + '.npy', {'dists': dists})
+    else:
+        n_samples = 100
+        n_dims = 50
+        items = [(i, n_samples, n + 1) for i in range(n_images) for n in range(n_dims)]
+        result_dir = './data/dists_to_bnd_' + name + '_sweep'
+        run_sweep(items, result_dir, n_workers)
+
+        dists = np.zeros((n_images, n_dims, n_samples))
+        angles = np.zeros((n_images, n_dims, n_samples))
+        largest_vecs = np.zeros((n_images, n_dims, data['dirs'].shape[-1]))
+        for i in range(n_images):
+            for n in range(n_dims):
+                dists[i, n], angles[i, n], largest_vecs[i, n] = load_item(result_dir, (i, n_samples, n + 1))
+        np.save('./data/dists_to_bnd_' + name + '.npy', {
+            'dists': dists,
+            'angles': angles,
+            'largest_vecs': largest_vecs
+        })
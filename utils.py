@@ -1,6 +1,12 @@
+import json
+import os
+import tempfile
+
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torchvision.datasets as datasets
+import tqdm
 
 
 def orth_check(adv_dirs):
@@ -56,67 +62,311 @@ def map_to(x, tmin, tmax, rmin=0, rmax=1):
     return x_t
 
 
-def make_orth_basis(dirs=[], n_pixels=784, n_iterations=3):
-    basis = np.random.uniform(-1, 1, (n_pixels - len(dirs), n_pixels))
-    basis = basis / np.linalg.norm(basis, axis=-1, keepdims=True)
-    if len(dirs) > 0:
-        basis_with_dirs = np.concatenate((dirs, basis), axis=0)
+def make_orth_basis(dirs=[], n_pixels=784, n_iterations=3, n_vectors=None, seed=None, device=None):
+    """
+    Random orthonormal basis (one vector per row) of the orthogonal complement of dirs. The random vectors are
+    orthogonalized against dirs and each other with a single Householder QR decomposition, with signs fixed such
+    that the result equals Gram-Schmidt on the same random vectors. n_iterations is only kept for compatibility,
+    QR does not need repeated passes.
+
+    n_vectors: if given, only the first n_vectors basis vectors are computed (the same as the first rows of the
+        full basis for the same random state), which is much cheaper when only a small subspace is needed.
+    seed: seed of a dedicated random generator, the global numpy random state is used if None.
+    device: torch device to run the decomposition on (e.g. 'cuda:0'), numpy is used if None.
+    """
+    n_dirs = len(dirs)
+    if n_vectors is None:
+        n_vectors = n_pixels - n_dirs
+    rng = np.random if seed is None else np.random.default_rng(seed)
+    basis = rng.uniform(-1, 1, (n_vectors, n_pixels))
+    if n_dirs > 0:
+        basis = np.concatenate((np.asarray(dirs).reshape((n_dirs, n_pixels)), basis), axis=0)
+
+    if device is None:
+        q, r = np.linalg.qr(basis.T)
+        signs = np.sign(np.diag(r))
     else:
-        basis_with_dirs = basis.copy()
+        q, r = torch.linalg.qr(torch.as_tensor(basis.T, device=device))
+        signs = torch.sign(torch.diagonal(r)).cpu().numpy()
+        q = q.cpu().numpy()
+    signs[signs == 0] = 1
+    return (q * signs[None]).T[n_dirs:]
+
 
-    for it in range(n_iterations):
-        for i, v in enumerate(basis):
-            v_orth = v - ((basis_with_dirs[:len(dirs) + i] * v.reshape((1, -1))).sum(-1, keepdims=True) *
-                          basis_with_dirs[:len(dirs) + i]).sum(0)
-            u_orth = v_orth / np.linalg.norm(v_orth)
-            basis_with_dirs[len(dirs) + i] = u_orth
-            basis[i] = u_orth
+def get_dist_dec(orig, label, dirs, model, min_dist=.1, n_samples=1000, rtol=None, box_exit=False,
+                 return_n_saved=False, seed=None):
+    results = get_dist_dec_batch([orig], [label], [dirs], model, min_dists=[min_dist], n_samples=n_samples,
+                                 batch_size=100, rtol=rtol, box_exit=box_exit, return_n_saved=return_n_saved,
+                                 seed=seed)
+    dists, angles, largest_vecs = results[:3]
+    if return_n_saved:
+        return dists[0], angles[0], largest_vecs[0], results[3]
+    return dists[0], angles[0], largest_vecs[0]
 
-    return basis
 
+def get_dist_dec_batch(origs, labels, dirs, model, min_dists, n_samples=1000, batch_size=1000, rtol=None,
+                       box_exit=False, return_n_saved=False, seed=None):
+    """
+    get_dist_dec for many (image, direction set) pairs at once. The bisection of all samples of all pairs runs in
+    shared model batches of batch_size, so e.g. all 50 direction prefixes of an image need one set of 20 steps.
+    origs, labels, dirs and min_dists hold one entry per pair (the direction sets may differ in size).
+    Returns dists and angles of shape (n_pairs, n_samples) and largest_vecs of shape (n_pairs, n_pixels).
 
-def get_dist_dec(orig, label, dirs, model, min_dist=.1, n_samples=1000):
-    shape = orig.shape
+    With rtol set, samples stop being evaluated once their bracket is below rtol relative to the distance, or once
+    they left [0, 1]^n without finding the boundary (those end up as NaN anyway), and the search stops as soon as
+    no sample is left. With return_n_saved, the number of model evaluations saved compared to the full 20 steps
+    is returned as well.
+
+    With box_exit, the largest scale for which a ray stays in [0, 1]^n is computed in closed form beforehand and
+    the search is clamped to it: rays that leave the box before min_dist are never evaluated, and rays that are
+    still not adversarial at their exit scale are dropped (their distance is NaN).
+
+    Only the random coefficients of the samples are kept (n_samples x len(dirs[p]) per pair), the sample directions
+    themselves are computed per model batch, so memory is bounded by batch_size instead of n_pairs * n_samples
+    images. The coefficients of every pair come from their own generator, spawned from seed (drawn from the global
+    numpy random state if None).
+    """
+    n_pairs = len(origs)
+    shape = origs[0].shape
     n_steps = 20
-    n_dirs = len(dirs)
-    dirs = dirs.reshape((n_dirs, -1))
+    origs = np.stack([np.asarray(orig).reshape(-1) for orig in origs])
+    dirs = [np.asarray(d).reshape((len(d), -1)) for d in dirs]
+    pair_idx = np.repeat(np.arange(n_pairs), n_samples)
+    sample_labels = np.repeat(np.asarray(labels).reshape(-1), n_samples)
+    min_dists = np.repeat(np.broadcast_to(np.asarray(min_dists, dtype=float), (n_pairs,)), n_samples)[:, None]
 
-    upper = np.full((n_samples, 1), np.inf)
-    lower = np.ones((n_samples, 1)) * min_dist
+    upper = np.full((n_pairs * n_samples, 1), np.inf)
+    lower = min_dists.copy()
 
-    scales = np.ones((n_samples, 1)) * min_dist
+    scales = min_dists.copy()
 
-    coeffs = abs(np.random.normal(size=[n_samples, n_dirs]))
-    sample_dirs = (coeffs @ dirs)
-    sample_dirs = sample_dirs / np.linalg.norm(sample_dirs, axis=-1, keepdims=True)
+    if seed is None:
+        seed = np.random.randint(2**31)
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_pairs)]
+    coeffs = [abs(rng.normal(size=[n_samples, len(d)])) for rng, d in zip(rngs, dirs)]
+    grams = [d @ d.T for d in dirs]
+    # norms of the unnormalized sample directions coeffs @ d
+    norms = np.concatenate([np.sqrt(np.einsum('ij,jk,ik->i', c, g, c)) for c, g in zip(coeffs, grams)])
+    sample_idx = np.tile(np.arange(n_samples), n_pairs)
 
-    dists = np.full(n_samples, np.nan)
-    found_advs = np.full(n_samples, False)
-    for i in range(n_steps):
-        input_dirs = scales * sample_dirs
-        input_ = input_dirs + orig.flatten()[None]
-        input = torch.split(torch.tensor(input_.reshape((-1,) + shape), device=dev()), 100)
+    def get_sample_dirs(batch):
+        # the normalized sample directions of a batch of samples (indices into all pairs' samples)
+        sample_dirs = np.empty((len(batch), origs.shape[-1]))
+        batch_pairs = pair_idx[batch]
+        for p in np.unique(batch_pairs):
+            rows = batch_pairs == p
+            sample_dirs[rows] = coeffs[p][sample_idx[batch[rows]]] @ dirs[p]
+        return sample_dirs / norms[batch, None]
 
-        preds = np.empty(0)
-        for batch in input:
-            preds = np.concatenate((preds, model(batch).argmax(-1).cpu().numpy()), axis=0)
+    dists = np.full(n_pairs * n_samples, np.nan)
+    found_advs = np.full(n_pairs * n_samples, False)
+    in_bounds = np.full(n_pairs * n_samples, True)
+    preds = np.empty(n_pairs * n_samples)
+    active = np.full(n_pairs * n_samples, True)
+    if box_exit:
+        exit_scales = np.empty((n_pairs * n_samples, 1))
+        for start in range(0, n_pairs * n_samples, batch_size):
+            batch = np.arange(start, min(start + batch_size, n_pairs * n_samples))
+            exit_scales[batch, 0] = ray_box_exit(origs, get_sample_dirs(batch), pair_idx[batch], batch_size)
+        active[exit_scales[:, 0] < min_dists[:, 0]] = False
+    n_evals = 0
+    for i in range(n_steps):
+        active_idx = np.flatnonzero(active)
+        if len(active_idx) == 0:
+            break
+        for start in range(0, len(active_idx), batch_size):
+            batch = active_idx[start:start + batch_size]
+            input_ = scales[batch] * get_sample_dirs(batch) + origs[pair_idx[batch]]
+            in_bounds[batch] = np.logical_and(input_.max(-1) <= 1, input_.min(-1) >= 0)
+            with torch.no_grad():
+                preds[batch] = model(torch.tensor(input_.reshape((-1,) + shape), device=dev())).argmax(-1).cpu().numpy()
+        n_evals += len(active_idx)
+        if box_exit:
+            # the analytic limit decides, rounding at the exit scale may push the input just outside of the box
+            in_bounds[active_idx] = scales[active_idx, 0] <= exit_scales[active_idx, 0]
+            at_exit = np.logical_and(active, scales[:, 0] >= exit_scales[:, 0])
 
-        is_adv = np.invert(preds == label)
+        is_adv = np.logical_and(active, np.invert(preds == sample_labels))
+        not_adv = np.logical_and(active, preds == sample_labels)
         found_advs[is_adv] = True
         dists[is_adv] = scales[is_adv, 0]
 
         upper[is_adv] = scales[is_adv]
-        lower[~is_adv] = scales[~is_adv]
-        scales[found_advs] = (upper[found_advs] + lower[found_advs]) / 2
-        scales[~found_advs] = lower[~found_advs] * 2
-
-        in_bounds = np.logical_and(input_.max(-1) <= 1, input_.min(-1) >= 0)
-        dists[~in_bounds] = np.nan
-    if np.all(np.isnan(dists)):
-        largest_vec = np.zeros(dirs.shape[-1])
-    else:
-        largest_vec = sample_dirs[np.nanargmax(dists)]
-    angles = np.arccos((sample_dirs@dirs.T).clip(-1,1)).min(-1)
+        lower[not_adv] = scales[not_adv]
+        bisect = np.logical_and(active, found_advs)
+        expand = np.logical_and(active, ~found_advs)
+        scales[bisect] = (upper[bisect] + lower[bisect]) / 2
+        scales[expand] = lower[expand] * 2
+        if box_exit:
+            scales[expand] = np.minimum(scales[expand], exit_scales[expand])
+
+        dists[np.logical_and(active, ~in_bounds)] = np.nan
+
+        if box_exit:
+            # the boundary can not be reached inside the box along these rays
+            active[np.logical_and(at_exit, ~found_advs)] = False
+
+        if rtol is not None:
+            converged = np.logical_and(~np.isnan(dists), (upper - lower)[:, 0] <= rtol * upper[:, 0])
+            left_box = np.logical_and(~found_advs, ~in_bounds)
+            active[np.logical_or(converged, left_box)] = False
+    dists = dists.reshape((n_pairs, n_samples))
+    pair_norms = norms.reshape((n_pairs, n_samples))
+    angles = np.full((n_pairs, n_samples), np.nan)
+    largest_vecs = np.zeros((n_pairs, origs.shape[-1]))
+    for p in range(n_pairs):
+        if not np.all(np.isnan(dists[p])):
+            largest_vecs[p] = get_sample_dirs(np.array([p * n_samples + np.nanargmax(dists[p])]))[0]
+        # cosines of the sample directions with the directions, coeffs @ d @ d^T / norms
+        angles[p] = np.arccos((coeffs[p] @ grams[p] / pair_norms[p][:, None]).clip(-1, 1)).min(-1)
     angles[np.isnan(dists)] = np.nan
 
-    return dists, angles, largest_vec
\ No newline at end of file
+    if return_n_saved:
+        return dists, angles, largest_vecs, n_steps * n_pairs * n_samples - n_evals
+    return dists, angles, largest_vecs
+
+
+def ray_box_exit(origs, sample_dirs, pair_idx, batch_size=1000):
+    """
+    Largest scale s for which origs[pair_idx] + s * sample_dirs stays inside [0, 1]^n, for every ray.
+    """
+    exit_scales = np.empty(len(sample_dirs))
+    for start in range(0, len(sample_dirs), batch_size):
+        batch = slice(start, start + batch_size)
+        d = sample_dirs[batch]
+        o = origs[pair_idx[batch]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            limits = np.where(d > 0, (1 - o) / d, np.where(d < 0, -o / d, np.inf))
+        exit_scales[batch] = limits.min(-1)
+    return exit_scales
+
+
+def init_pool_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+
+def run_pool(func, args, n_workers, shared_models=()):
+    """
+    Calls func (a module level function) on every element of args, in a fork pool of n_workers processes that share
+    the memory of shared_models and split the torch threads of the machine between them. The results are yielded in
+    the order they finish, with a progress bar.
+    """
+    # cuda can not be shared with forked workers, run on the main process then
+    if n_workers <= 1 or dev() != 'cpu':
+        for a in tqdm.tqdm(args):
+            yield func(a)
+        return
+    for model in shared_models:
+        model.share_memory()
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    with mp.get_context('fork').Pool(n_workers, initializer=init_pool_worker, initargs=(n_threads,)) as pool:
+        yield from tqdm.tqdm(pool.imap_unordered(func, args), total=len(args))
+
+
+def save_npz_atomic(filename, **arrays):
+    """
+    np.savez to filename through a temporary file in the same directory, so a killed job never leaves a partially
+    written file behind. The temporary name is unique (ending in '.tmp.npz'), so concurrent jobs writing the same
+    file do not race on it; the last os.replace wins.
+    """
+    fd, tmp_filename = tempfile.mkstemp(suffix='.tmp.npz', prefix=os.path.basename(filename) + '.',
+                                        dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def save_memmap_dict(directory, data):
+    """
+    Saves a dict of arrays in the memory-mapped result format: one raw C-ordered file <field>.bin per field plus a
+    meta.json with the dtype and shape of every field. Read it back with load_memmap_dict.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta = {}
+    for field, value in data.items():
+        value = value.detach().cpu().numpy() if torch.is_tensor(value) else np.asarray(value)
+        assert value.dtype != object, f'field {field} can not be memory-mapped'
+        meta[field] = {'dtype': value.dtype.str, 'shape': list(value.shape)}
+        if value.size == 0:
+            open(os.path.join(directory, field + '.bin'), 'wb').close()
+            continue
+        array = np.memmap(os.path.join(directory, field + '.bin'), dtype=value.dtype, mode='w+', shape=value.shape)
+        array[...] = value
+        array.flush()
+        del array
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def open_memmap_field(directory, field, dtype, shape, fill=None):
+    """
+    Creates (or replaces) a single field of a memory-mapped result directory (see save_memmap_dict) and returns it
+    as a writable np.memmap, so that it can be filled in place piece by piece instead of from one array in memory.
+    fill initializes the field (zeros for None). The field is added to the meta.json of the directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta_filename = os.path.join(directory, 'meta.json')
+    meta = {}
+    if os.path.isfile(meta_filename):
+        with open(meta_filename) as f:
+            meta = json.load(f)
+    dtype = np.dtype(dtype)
+    shape = tuple(int(n) for n in shape)
+    meta[field] = {'dtype': dtype.str, 'shape': list(shape)}
+    filename = os.path.join(directory, field + '.bin')
+    if np.prod(shape) == 0:
+        open(filename, 'wb').close()
+        array = np.zeros(shape, dtype=dtype)
+    else:
+        array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        if fill is not None:
+            array[...] = fill
+    with open(meta_filename, 'w') as f:
+        json.dump(meta, f, indent=1)
+    return array
+
+
+def load_memmap_dict(directory, mode='r'):
+    """
+    Opens a result directory written by save_memmap_dict. Every field is a read-only np.memmap, so only the
+    images and dimensions that are indexed are read from disk.
+    """
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    data = {}
+    for field, info in meta.items():
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            data[field] = np.zeros(shape, dtype=info['dtype'])
+        else:
+            data[field] = np.memmap(os.path.join(directory, field + '.bin'), dtype=info['dtype'], mode=mode,
+                                    shape=shape)
+    return data
+
+
+def load_result_dict(path):
+    """
+    Loads the results of a decomposition run. Uses the memory-mapped version of path (the same path without the
+    .npy extension, see convert_npy_dict) if it exists and falls back to the pickled dict otherwise.
+    """
+    directory = path[:-len('.npy')] if path.endswith('.npy') else path
+    if os.path.isfile(os.path.join(directory, 'meta.json')):
+        return load_memmap_dict(directory)
+    return np.load(path, allow_pickle=True).item()
+
+
+def convert_npy_dict(path, directory=None):
+    """
+    Converts a pickled result dict (np.save of a dict) into the memory-mapped format, by default next to it.
+    """
+    if directory is None:
+        directory = path[:-len('.npy')]
+    save_memmap_dict(directory, np.load(path, allow_pickle=True).item())
+    return directory